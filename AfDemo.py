@@ -30,6 +30,8 @@ class AfDemo(QtGui.QWidget):
         self.afX = 0
         self.afY = 0
         self.afN = 0
+        # Tracking autofocus (None: off).
+        self.tracker = None
         # Initialize gui.
         self.init_gui()
 
@@ -63,9 +65,12 @@ class AfDemo(QtGui.QWidget):
             if self.lenseControl.lense_init:
                 pass
                 self.afBox.startBtn.setEnabled(True)
+                self.afBox.trackCheck.setEnabled(True)
         else:
             self.cam_connected = False
             self.afBox.startBtn.setEnabled(False)
+            self.afBox.trackCheck.setChecked(False)
+            self.afBox.trackCheck.setEnabled(False)
 
     def lenseConnection(self):
         # Callback for lense connection changes
@@ -75,9 +80,47 @@ class AfDemo(QtGui.QWidget):
             if self.camControl.cam_connected:
                 # If camera has already been connected: enable autofocus.
                 self.afBox.startBtn.setEnabled(True)
+                self.afBox.trackCheck.setEnabled(True)
         else:
             self.lense_init = False
             self.afBox.startBtn.setEnabled(False)
+            self.afBox.trackCheck.setChecked(False)
+            self.afBox.trackCheck.setEnabled(False)
+
+    def get_roi(self):
+        # Currently selected AOI coordinates.
+        return [
+                self.aoiBox.x1,
+                self.aoiBox.y1,
+                self.aoiBox.x2,
+                self.aoiBox.y2]
+
+    def start_tracking(self):
+        # Callback for tracking autofocus on/off. The tracker starts
+        # from the current lense position, which is taken as in focus.
+        if self.afBox.tracking and self.cam_connected and self.lense_init:
+            self.tracker = psl.FocusTracker(
+                                    self.cam,
+                                    self.lc.focus,
+                                    self.get_roi(),
+                                    self.afBox.start,
+                                    self.afBox.stop,
+                                    self.afBox.hyst)
+        else:
+            self.tracker = None
+
+    def track(self):
+        # Feed new video frame to tracking autofocus.
+        img = self.camControl.currImg
+        # No new frame ready.
+        if self.tracker is None or img.size <= 1:
+            return
+        roi = self.get_roi()
+        if roi != self.tracker.aoi:
+            # The peak value belongs to the old AOI: start over.
+            self.start_tracking()
+        self.tracker.update(img[roi[1]:roi[3], roi[0]:roi[2]])
+        self.lenseControl.focusSlider.setValue(self.tracker.goto)
 
     def draw_aoi_mouse(self, event, x, y, flags, param):
         # Callback function for AOI selection by drag&drop an video screen.
@@ -116,11 +159,7 @@ class AfDemo(QtGui.QWidget):
         # Disable GUI.
         self.setEnabled(False)
         # Get currently selected AOI coordinates.
-        roi = [
-                self.aoiBox.x1,
-                self.aoiBox.y1,
-                self.aoiBox.x2,
-                self.aoiBox.y2]
+        roi = self.get_roi()
         # Stop video.
         if self.camControl.video_running:
             self.camControl.videoTimer.stop()
@@ -164,6 +203,8 @@ class AfDemo(QtGui.QWidget):
         # Set focus to calculated position.
         self.lc.focus.go_to_position(self.afX)
         self.lenseControl.focusSlider.setValue(self.afX)
+        # Restart tracking from the new focus position.
+        self.start_tracking()
         QtGui.QApplication.restoreOverrideCursor()
 
     def init_gui(self):
@@ -252,10 +293,15 @@ class AfDemo(QtGui.QWidget):
         # Connect signals from sub widgets to callback functions.
         self.camControl.connection_changed.connect(self.camConnection)
         self.lenseControl.connection_changed.connect(self.lenseConnection)
+        # Tracking needs the frame without the AOI rectangle:
+        # connect before draw_aoi.
+        self.camControl.new_frame.connect(self.track)
         self.camControl.new_frame.connect(self.draw_aoi)
         self.camControl.video_start.connect(self.applyMouseCB)
         self.afBox.af_started.connect(self.start_af)
+        self.afBox.tracking_changed.connect(self.start_tracking)
         self.afBox.startBtn.setEnabled(False)
+        self.afBox.trackCheck.setEnabled(False)
 
     def closeEvent(self, event):
         cv2.destroyAllWindows()
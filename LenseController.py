@@ -1,15 +1,19 @@
 import sys
 import time
-import RPi.GPIO as GPIO
+try:
+    import RPi.GPIO as GPIO
+except ImportError:
+    # not on a Raspberry Pi: pass a gpio backend, e.g. simulation.SimGPIO
+    GPIO = None
 
 
 class LenseController:
     """
     Controls the Stepper Motors
+    gpio: backend with the RPi.GPIO interface (default: RPi.GPIO), may
+    have a sleep(seconds) method used for the step delays
     """
 
-    GPIO.setmode(GPIO.BCM)
-
     # ID
     irisID = 0
     focusID = 1
@@ -26,24 +30,28 @@ class LenseController:
     # motor delay
     motorDelay = [0.003, 0.001, 0.001]
 
-    def __init__(self):
+    def __init__(self, gpio=None):
 
-        GPIO.setmode(GPIO.BCM)
+        self.gpio = _backend(gpio)
+        self.gpio.setmode(self.gpio.BCM)
 
     def open(self):
         # open lense controllers
         self.iris = DriverController(
                                     self.irisPins,
                                     self.maxPositions[self.irisID],
-                                    self.motorDelay[self.irisID])
+                                    self.motorDelay[self.irisID],
+                                    self.gpio)
         self.focus = DriverController(
                                     self.focusPins,
                                     self.maxPositions[self.focusID],
-                                    self.motorDelay[self.focusID])
+                                    self.motorDelay[self.focusID],
+                                    self.gpio)
         self.zoom = DriverController(
                                     self.zoomPins,
                                     self.maxPositions[self.zoomID],
-                                    self.motorDelay[self.zoomID])
+                                    self.motorDelay[self.zoomID],
+                                    self.gpio)
 
         print('All lenses are now on minimum setting!')
 
@@ -52,7 +60,7 @@ class LenseController:
         self.iris.disable()
         self.focus.disable()
         self.zoom.disable()
-        GPIO.cleanup()
+        self.gpio.cleanup()
 
     def disable_drivers(self):
         # disable all motors
@@ -78,8 +86,15 @@ class DriverController:
     # setting motor current position
     # motors will be set to this position in __init__
 
-    def __init__(self, pins, maxPosition, delay):
+    def __init__(self, pins, maxPosition, delay, gpio=None):
 
+        self.gpio = _backend(gpio)
+        self.sleep = getattr(self.gpio, 'sleep', time.sleep)
+        # simulated backends bring their own clock
+        clock = getattr(self.gpio, 'clock', None)
+        self.now = time.monotonic if clock is None else clock.time
+        # (time, position) of each step pulse while it is a list
+        self.timeline = None
         self.pins = pins
         self.maxPosition = maxPosition
         self.delay = delay
@@ -87,7 +102,7 @@ class DriverController:
 
         # Set all pins as output
         for pin in self.pins:
-            GPIO.setup(pin, GPIO.OUT)
+            self.gpio.setup(pin, self.gpio.OUT)
 
         self.enable()
 
@@ -102,7 +117,11 @@ class DriverController:
         if self.isEnabled() is False:
             print('Lense is disbaled!')
             return False
+        elif stepCount == 0:
+            # already there
+            return self.currPosition
         else:
+            first = self.currPosition
             self.currPosition = self.currPosition + stepCount
             if (self.currPosition < 0):
                 self.currPosition = 0
@@ -110,17 +129,21 @@ class DriverController:
                 self.currPosition = self.maxPosition
 
             if (stepCount > 0):
-                GPIO.output(self.pins[0], True)
+                self.gpio.output(self.pins[0], True)
             elif (stepCount < 0):
-                GPIO.output(self.pins[0], False),
+                self.gpio.output(self.pins[0], False),
             else:
                 raise Exception('Direction Error!')
 
+            direction = 1 if stepCount > 0 else -1
             for i in range(0, abs(stepCount)):
-                GPIO.output(self.pins[1], True)
-                time.sleep(self.delay)
-                GPIO.output(self.pins[1], False)
-                time.sleep(self.delay)
+                self.gpio.output(self.pins[1], True)
+                if self.timeline is not None:
+                    self.timeline.append((self.now(), min(max(
+                        first + direction * (i + 1), 0), self.maxPosition)))
+                self.sleep(self.delay)
+                self.gpio.output(self.pins[1], False)
+                self.sleep(self.delay)
             return self.currPosition
 
     def get_position(self):
@@ -146,14 +169,23 @@ class DriverController:
         return self.go_to_position(self.maxPosition)
 
     def enable(self):
-        GPIO.output(self.pins[2], False)
+        self.gpio.output(self.pins[2], False)
         self.status = True
         return True
 
     def disable(self):
-        GPIO.output(self.pins[2], True)
+        self.gpio.output(self.pins[2], True)
         self.status = False
         return True
 
     def isEnabled(self):
         return self.status
+
+
+def _backend(gpio):
+    # gpio backend to use: gpio or RPi.GPIO
+    if gpio is not None:
+        return gpio
+    if GPIO is None:
+        raise RuntimeError('RPi.GPIO is not available, pass a gpio backend')
+    return GPIO
@@ -941,6 +941,9 @@ class AfBox(QtGui.QWidget):
     # Create signal to inform other widgets,
     # that the autofocus is in progress.
     af_started = QtCore.Signal()
+    # Create signal to inform other widgets,
+    # that tracking autofocus was switched on or off.
+    tracking_changed = QtCore.Signal()
 
     def __init__(self, parent, minF, maxF, cStepMin, fStepMin):
         # Constructor
@@ -955,6 +958,7 @@ class AfBox(QtGui.QWidget):
         self.fStepMin = fStepMin
         self.fStep = fStepMin
         self.algorithm = 0
+        self.tracking = False
         self.init_gui()
 
     def update_af_edits(self, index):
@@ -1016,6 +1020,28 @@ class AfBox(QtGui.QWidget):
             self.pFStepEdit.setText(str(fStep))
             self.af_started.emit()
 
+    def tracking_CB(self):
+        # Switch tracking autofocus on or off.
+        self.tracking = self.trackCheck.isChecked()
+        if self.tracking:
+            # Get focus range and hysteresis, the lense is kept
+            # within start and stop while tracking.
+            start = set_to_min_max(
+                            self.pStartEdit.text(), self.minF,
+                            self.maxF, self.minF)
+            stop = set_to_min_max(
+                            self.pStopEdit.text(), self.minF,
+                            self.maxF, self.maxF)
+            if start >= stop:
+                start = self.minF
+                stop = self.maxF
+            self.hyst = set_to_min_max(self.hystEdit.text(), -1000, 1000, 0)
+            self.start = start
+            self.stop = stop
+            self.pStartEdit.setText(str(start))
+            self.pStopEdit.setText(str(stop))
+        self.tracking_changed.emit()
+
     def init_gui(self):
         # Initialize GUI.
         # Create main and sub layout.
@@ -1034,6 +1060,9 @@ class AfBox(QtGui.QWidget):
         # Create start autofocus button.
         self.startBtn = QtGui.QPushButton("Start AF")
         self.startBtn.clicked.connect(self.start_af)
+        # Create checkbox for tracking autofocus on live video.
+        self.trackCheck = QtGui.QCheckBox('Tracking AF')
+        self.trackCheck.stateChanged.connect(self.tracking_CB)
         # Add newly created widgets to layout.
         leftLayout.addWidget(
                         self.algBox, 0, 0, 1, 1,
@@ -1041,6 +1070,9 @@ class AfBox(QtGui.QWidget):
         leftLayout.addWidget(
                         self.startBtn, 1, 0, 1, 1,
                         alignment=QtCore.Qt.AlignLeft)
+        leftLayout.addWidget(
+                        self.trackCheck, 2, 0, 1, 1,
+                        alignment=QtCore.Qt.AlignLeft)
 
         # Create layout for edit fields.
         pSubLayout = QtGui.QGridLayout(self)
@@ -0,0 +1,260 @@
+# end to end benchmark of the autofocus searches on simulated (or
+# recorded) lens and camera, reports per run the frames grabbed, motor
+# steps, direction reversals, simulated time and the focus error
+#
+# python benchmark_autofocus.py [--in-focus 800 2500 4200] [--backlash 5]
+#                               [--recording sweep.npz] [--out af.json]
+
+import argparse
+import json
+import sys
+import numpy as np
+import peak_search_lense_final as psl
+import simulation as sim
+
+# search settings, like the defaults of the AfDemo GUI but with steps
+# which fit the 6000 steps of the focus motor
+SETTINGS = {
+    'start': 0,
+    'stop': 6000,
+    'c_step': 200,
+    'f_step': 20,
+    'tolerance': 4,
+    'hysteresis': 0,
+    'aoi': [160, 120, 480, 360],
+    'measure': ('TENENGRAD1', 7, 0),
+    'pipeline': 0,
+    'fit': 'lorentz',
+    # lens position before the search (hill_climb starts there), None:
+    # wherever the last run left the lens
+    'initial': 0}
+
+
+def _single_step(cam, focus, s):
+    x, y, n = psl.global_peak_single_step(
+                        cam, focus, s['f_step'], s['start'], s['stop'],
+                        s['aoi'], measure=s['measure'],
+                        pipeline=s['pipeline'], cache=s.get('cache'),
+                        hysteresis=s['hysteresis'])
+    return x - s['hysteresis'], n
+
+
+def _two_step(cam, focus, s):
+    x, y, n = psl.global_peak_two_step(
+                        cam, focus, s['c_step'], s['f_step'], s['start'],
+                        s['stop'], s['aoi'], s['hysteresis'],
+                        measure=s['measure'], pipeline=s['pipeline'],
+                        fit=s['fit'], cache=s.get('cache'))
+    return x - s['hysteresis'], n
+
+
+def _fibonacci(cam, focus, s):
+    x, y, n = psl.fibonacci_peak(
+                        cam, focus, s['start'], s['stop'], s['aoi'],
+                        s['hysteresis'], s['tolerance'], s['measure'],
+                        s.get('cache'))
+    return x, n
+
+
+def _continuous(cam, focus, s):
+    x, y, n = psl.global_peak_continuous(
+                        cam, focus, s['start'], s['stop'], s['aoi'],
+                        measure=s['measure'])
+    return x - s['hysteresis'], n
+
+
+def _hill_climb(cam, focus, s):
+    x, y, n = psl.hill_climb_peak(
+                        cam, focus, s['start'], s['stop'], s['aoi'],
+                        s['hysteresis'], s['c_step'], s['tolerance'],
+                        measure=s['measure'], cache=s.get('cache'))
+    return x, n
+
+
+def _brent(cam, focus, s):
+    x, y, n = psl.brent_peak(
+                        cam, focus, s['start'], s['stop'], s['aoi'],
+                        s['hysteresis'], s['tolerance'], s['measure'],
+                        s.get('cache'))
+    return x, n
+
+
+# name: function(cam, focus, settings) returning (focus position, nCount)
+# with the position the lens is moved to afterwards (as in AfDemo),
+# settings['cache'] is a ScoreCache or missing
+SEARCHES = {
+    'single_step': _single_step,
+    'two_step': _two_step,
+    'fibonacci': _fibonacci,
+    'continuous': _continuous,
+    'hill_climb': _hill_climb,
+    'brent': _brent}
+
+
+def run_search(search, cam, lense, stepper, in_focus, settings=SETTINGS):
+    """
+    runs search (a SEARCHES function) on cam and lense.focus, then moves
+    the lens to the result. Returns a dict with the counters of the run:
+    frames, steps (pulses), reversals, time (s, including the final
+    move), n (nCount of the search), error (|result - in_focus|),
+    lens_error (|actual lens position - in_focus|, includes backlash and
+    lost steps) and hits (of settings['cache'])"""
+    clock = cam.clock
+    cache = settings.get('cache')
+    hits = 0 if cache is None else cache.hits
+    if settings['initial'] is not None:
+        lense.focus.go_to_position(settings['initial'])
+    frames, steps = cam.frames, stepper.steps
+    reversals, t = stepper.direction_changes, clock.time()
+    position, n = search(cam, lense.focus, settings)
+    lense.focus.go_to_position(int(round(position)))
+    return {
+        'frames': cam.frames - frames,
+        'steps': stepper.steps - steps,
+        'reversals': stepper.direction_changes - reversals,
+        'time': clock.time() - t,
+        'n': n,
+        'position': position,
+        'error': abs(position - in_focus),
+        'lens_error': abs(stepper.position - in_focus),
+        'hits': 0 if cache is None else cache.hits - hits}
+
+
+def run(searches, in_focus, backlash=0, step_loss=0.0, recording=None,
+        settings=SETTINGS, seed=0, log=None, runs=1, cache=False, ttl=None,
+        stay=False, chain=False):
+    """
+    runs every search for every ground truth position in in_focus on a
+    fresh simulated lense, returns one result dict per run. recording:
+    (positions, frames) to replay instead of rendering the scene, its
+    ground truth is in_focus as well. Each search runs runs times on the
+    same lense, with cache the runs share a ScoreCache (ttl). With stay
+    the runs after the first start at the focus the last run found (as
+    in AfDemo), not at settings['initial']. With chain all searches run
+    one after the other on the same lense (and cache), e.g. a sweep
+    followed by brent"""
+    results = []
+    groups = [searches] if chain else [[name] for name in searches]
+    for truth in in_focus:
+        for group in groups:
+            lense, gpio, steppers = sim.simulated_lense(
+                                        backlash=backlash,
+                                        step_loss=step_loss,
+                                        seed=seed)
+            stepper = steppers[lense.focusID]
+            if recording is None:
+                cam = sim.SimCamera(
+                            stepper, in_focus=truth, clock=gpio.clock,
+                            seed=seed)
+            else:
+                cam = sim.ReplayCamera(
+                            recording[0], recording[1], stepper,
+                            in_focus=truth, clock=gpio.clock, seed=seed)
+            cam.Open()
+            s = dict(settings)
+            if cache:
+                s['cache'] = psl.ScoreCache(ttl, gpio.clock.time)
+            for j, name in enumerate(group):
+                for i in range(runs):
+                    if stay and (i or j):
+                        s['initial'] = None
+                    result = run_search(
+                                SEARCHES[name], cam, lense, stepper, truth, s)
+                    result.update(search=name, in_focus=truth, run=i)
+                    results.append(result)
+                    if log is not None:
+                        log.write('%-12s focus %5d -> %7.1f  error %5.1f '
+                                  '(lens %4d)  %3d frames  %6d steps  '
+                                  '%2d reversals  %6.2f s  %3d hits\n' % (
+                                    name, truth, result['position'],
+                                    result['error'], result['lens_error'],
+                                    result['frames'], result['steps'],
+                                    result['reversals'], result['time'],
+                                    result['hits']))
+    return results
+
+
+def summary(results):
+    """mean of the counters per search"""
+    table = {}
+    for name in dict.fromkeys(r['search'] for r in results):
+        runs = [r for r in results if r['search'] == name]
+        table[name] = {k: float(np.mean([r[k] for r in runs])) for k in (
+            'frames', 'steps', 'reversals', 'time', 'error', 'lens_error')}
+    return table
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='end to end benchmark of the autofocus searches')
+    parser.add_argument('--search', nargs='+', default=list(SEARCHES),
+                        choices=list(SEARCHES))
+    parser.add_argument('--in-focus', nargs='+', type=int,
+                        default=[800, 2500, 4200],
+                        help='ground truth focus positions')
+    parser.add_argument('--backlash', type=int, default=0)
+    parser.add_argument('--hysteresis', type=int, default=None,
+                        help='hysteresis compensation (default: backlash)')
+    parser.add_argument('--step-loss', type=float, default=0.0)
+    parser.add_argument('--recording',
+                        help='.npz of simulation.record_sweep to replay')
+    parser.add_argument('--pipeline', type=int, default=0,
+                        help='queue length of the pipelined sweeps')
+    parser.add_argument('--fit', default='lorentz',
+                        choices=['parabola', 'gauss', 'lorentz', 'none'],
+                        help='peak interpolation of two_step')
+    parser.add_argument('--initial', type=int, default=0,
+                        help='lens position before the search')
+    parser.add_argument('--runs', type=int, default=1,
+                        help='runs of each search on the same lense')
+    parser.add_argument('--cache', action='store_true',
+                        help='runs share a ScoreCache')
+    parser.add_argument('--ttl', type=float, default=None,
+                        help='time to live of the cache entries in s')
+    parser.add_argument('--stay', action='store_true',
+                        help='runs after the first start where the last '
+                             'run left the lens')
+    parser.add_argument('--chain', action='store_true',
+                        help='the searches run one after the other on the '
+                             'same lense (and cache)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help='json file the results are written to')
+    args = parser.parse_args(argv)
+    settings = dict(SETTINGS)
+    settings['pipeline'] = args.pipeline
+    settings['initial'] = args.initial
+    settings['fit'] = None if args.fit == 'none' else args.fit
+    settings['hysteresis'] = args.backlash if args.hysteresis is None \
+        else args.hysteresis
+    recording = None
+    if args.recording:
+        recording = sim.load_recording(args.recording)
+        h, w = recording[1].shape[1:3]
+        settings['aoi'] = [0, 0, w, h]
+    results = run(
+                args.search, args.in_focus, args.backlash, args.step_loss,
+                recording, settings, args.seed, sys.stdout, args.runs,
+                args.cache, args.ttl, args.stay, args.chain)
+    table = summary(results)
+    print('%-12s %7s %8s %9s %8s %7s %10s' % (
+        'search', 'frames', 'steps', 'reversals', 'time/s', 'error',
+        'lens_error'))
+    for name, m in table.items():
+        print('%-12s %7.1f %8.0f %9.1f %8.2f %7.1f %10.1f' % (
+            name, m['frames'], m['steps'], m['reversals'], m['time'],
+            m['error'], m['lens_error']))
+    if args.out:
+        settings['measure'] = list(settings['measure'])
+        with open(args.out, 'w') as f:
+            json.dump({
+                'settings': settings,
+                'backlash': args.backlash,
+                'step_loss': args.step_loss,
+                'recording': args.recording,
+                'results': results,
+                'summary': table}, f, indent=1)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
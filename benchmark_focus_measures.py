@@ -0,0 +1,258 @@
+# micro benchmark of the focus measures in focus_measures.py on synthetic
+# textured images blurred to known defocus levels
+#
+# python benchmark_focus_measures.py [--quick] [--out results.json]
+#                                    [--baseline old.json] [--check]
+
+import argparse
+import itertools
+import json
+import platform
+import sys
+import time
+import tracemalloc
+import cv2
+import numpy as np
+from focus_measures import ContrastMeasures
+from simulation import textured_scene, defocus
+
+MEASURES = ('SML', 'CMSL', 'GLV', 'TENENGRAD1', 'JAEHNE', 'SPECTRAL')
+# measures which do not use the threshold
+NO_THRESHOLD = ('GLV', 'JAEHNE', 'SPECTRAL')
+WINDOW_SIZES = (3, 5, 7)
+THRESHOLDS = (0, 7)
+DTYPES = ('uint8', 'uint16', 'float32')
+SIZES = (128, 512, 1024)
+# gaussian sigma of the defocus levels, increasing blur
+DEFOCUS = (0.0, 0.7, 1.4, 2.8, 5.6)
+# (fm_name, dtype) known not to fall with every defocus level: on
+# integer images the spectral score reaches the quantisation noise
+# floor at large blur. Reported, but not counted as failure
+KNOWN_NOT_MONOTONIC = (('SPECTRAL', 'uint8'), ('SPECTRAL', 'uint16'))
+# image shapes of the agreement check, down to AOIs smaller than the
+# window (the scores handle those like fm(...).mean() does)
+AGREEMENT_SHAPES = ((64, 80), (1, 1), (1, 40), (40, 1), (3, 40), (40, 3),
+                    (5, 6), (6, 40))
+# relative tolerance of score(...) against fm(...).mean()
+AGREEMENT_RTOL = 1e-5
+# image shape which is no optimal DFT size, SPECTRAL plans pad it
+SPECTRAL_SHAPE = (97, 131)
+
+
+def _time(func, min_time):
+    """best time of one call of func in seconds"""
+    func()
+    best = float('inf')
+    runs = 0
+    start = time.perf_counter()
+    while runs < 3 or time.perf_counter() - start < min_time:
+        t = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t)
+        runs += 1
+    return best
+
+
+def _peak_memory(func):
+    """peak memory allocated by func in bytes (numpy and python only)"""
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def grid(quick=False):
+    """(fm_name, window_size, threshold, dtype, size) of all runs"""
+    sizes = SIZES[:2] if quick else SIZES
+    windows = WINDOW_SIZES[:2] if quick else WINDOW_SIZES
+    for fm_name, window_size, threshold, dtype, size in itertools.product(
+            MEASURES, windows, THRESHOLDS, DTYPES, sizes):
+        if fm_name in NO_THRESHOLD and threshold != THRESHOLDS[0]:
+            continue
+        yield fm_name, window_size, threshold, dtype, size
+
+
+def run(quick=False, min_time=0.05, log=None):
+    """runs the benchmark, returns a list of one dict per grid point"""
+    measures = ContrastMeasures()
+    scenes = {}
+    results = []
+    for fm_name, window_size, threshold, dtype, size in grid(quick):
+        if size not in scenes:
+            scenes[size] = textured_scene((size, size))
+        imgs = [defocus(scenes[size], s, dtype) for s in DEFOCUS]
+        img = imgs[0]
+        args = (fm_name, window_size, threshold)
+        fm_time = _time(lambda: measures.fm(img, *args).mean(), min_time)
+        score_time = _time(lambda: measures.score(img, *args), min_time)
+        peak = _peak_memory(lambda: measures.fm(img, *args).mean())
+        scores = [measures.score(i, *args) for i in imgs]
+        result = {
+            'fm_name': fm_name,
+            'window_size': window_size,
+            'threshold': threshold,
+            'dtype': dtype,
+            'size': size,
+            'fm_ms': fm_time * 1e3,
+            'score_ms': score_time * 1e3,
+            'fm_peak_bytes': peak,
+            'scores': scores,
+            # focus value has to fall with every defocus level
+            'monotonic': bool(np.all(np.diff(scores) < 0)),
+            'known': (fm_name, dtype) in KNOWN_NOT_MONOTONIC}
+        results.append(result)
+        if log is not None:
+            log.write('%-10s w=%d t=%d %-7s %4d  fm %8.3f ms  score %8.3f ms'
+                      '  %7d KiB  %s\n' % (
+                        fm_name, window_size, threshold, dtype, size,
+                        result['fm_ms'], result['score_ms'], peak // 1024,
+                        'ok' if result['monotonic'] else
+                        'not monotonic (known)' if result['known'] else
+                        'NOT MONOTONIC'))
+    return results
+
+
+def agreement(log=None):
+    """
+    checks that score (plan, parallel and streaming), fm_stack and
+    fm_multi agree with fm(...).mean() to AGREEMENT_RTOL on all
+    AGREEMENT_SHAPES, also at level 1 (as the searches use it). SPECTRAL
+    is left out, its score also counts the energy leaking into the DFT
+    padding. Returns the failures as strings"""
+    measures = ContrastMeasures()
+    parallel = ContrastMeasures(workers=2)
+    names = [m for m in MEASURES if m != 'SPECTRAL']
+    failed = []
+    for shape, dtype, window_size, level in itertools.product(
+            AGREEMENT_SHAPES, DTYPES, WINDOW_SIZES, (0, 1)):
+        scene = textured_scene(shape)
+        imgs = [defocus(scene, s, dtype) for s in DEFOCUS[:3]]
+        small = [measures.reduce(i, level) for i in imgs]
+        for fm_name in names:
+            threshold = 0 if fm_name in NO_THRESHOLD else THRESHOLDS[-1]
+            args = (fm_name, window_size, threshold)
+            case = '%s w=%d %s %dx%d level %d' % (
+                fm_name, window_size, dtype, shape[0], shape[1], level)
+            try:
+                ref = [float(measures.fm(i, *args).mean()) for i in small]
+                got = {
+                    'score': [measures.score(i, *args, level=level)
+                              for i in imgs],
+                    'parallel': [parallel.score(i, *args) for i in small],
+                    'streaming': [measures.score_streaming(i, *args,
+                                                           band_rows=2)
+                                  for i in small],
+                    'fm_stack': list(measures.fm_stack(small, *args)),
+                    'fm_multi': [measures.fm_multi(i, names, window_size,
+                                                   threshold)[fm_name]
+                                 for i in small]}
+            except Exception as e:
+                failed.append('%s: %r' % (case, e))
+                continue
+            for path, values in got.items():
+                if not np.allclose(values, ref, rtol=AGREEMENT_RTOL,
+                                   atol=1e-9):
+                    failed.append('%s: %s %s != %s' % (
+                        case, path, values, ref))
+    failed += _spectral_reuse()
+    if log is not None:
+        for f in failed:
+            log.write('disagrees: %s\n' % f)
+    return failed
+
+
+def _spectral_reuse():
+    """
+    SPECTRAL scores of a plan already used by fm must equal those of a
+    fresh plan (the padding of the DFT has to stay zero). Returns the
+    failures as strings"""
+    failed = []
+    scene = textured_scene(SPECTRAL_SHAPE)
+    for dtype, window_size in itertools.product(DTYPES, WINDOW_SIZES):
+        sharp, blurred = [defocus(scene, s, dtype) for s in DEFOCUS[:3:2]]
+        args = ('SPECTRAL', window_size, 0)
+        ref = ContrastMeasures().score(blurred, *args)
+        measures = ContrastMeasures()
+        measures.fm(sharp, *args)
+        value = measures.score(blurred, *args)
+        if not np.isclose(value, ref, rtol=AGREEMENT_RTOL, atol=1e-9):
+            failed.append('SPECTRAL w=%d %s %dx%d: score after fm %s != %s' %
+                          ((window_size, dtype) + SPECTRAL_SHAPE +
+                           (value, ref)))
+    return failed
+
+
+def _key(r):
+    return r['fm_name'], r['window_size'], r['threshold'], r['dtype'], \
+        r['size']
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    results which are more than tolerance slower than in baseline or lost
+    their monotonic response, as (result, baseline result) pairs"""
+    old = {_key(r): r for r in baseline}
+    worse = []
+    for r in results:
+        b = old.get(_key(r))
+        if b is None:
+            continue
+        if r['score_ms'] > b['score_ms'] * (1 + tolerance) or \
+                r['fm_ms'] > b['fm_ms'] * (1 + tolerance) or \
+                (b['monotonic'] and not r['monotonic']):
+            worse.append((r, b))
+    return worse
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='micro benchmark of the focus measures')
+    parser.add_argument('--quick', action='store_true',
+                        help='smaller grid')
+    parser.add_argument('--min-time', type=float, default=0.05,
+                        help='seconds each timing runs at least')
+    parser.add_argument('--out',
+                        help='json file the results are written to')
+    parser.add_argument('--baseline',
+                        help='json file of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative slowdown reported as regression')
+    parser.add_argument('--check', action='store_true',
+                        help='only check that the scores agree with the '
+                             'focus maps')
+    args = parser.parse_args(argv)
+    disagree = agreement(sys.stdout)
+    print('%d scores disagree with the focus maps' % len(disagree))
+    if args.check:
+        return 1 if disagree else 0
+    results = run(args.quick, args.min_time, sys.stdout)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'opencv': cv2.__version__,
+                'machine': platform.machine(),
+                'defocus': DEFOCUS,
+                'results': results}, f, indent=1)
+    failed = [r for r in results if not r['monotonic'] and not r['known']]
+    known = [r for r in results if not r['monotonic'] and r['known']]
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(
+                            results, json.load(f)['results'], args.tolerance)
+        for r, b in regressions:
+            print('regression: %s w=%d t=%d %s %d  score %.3f -> %.3f ms  '
+                  'fm %.3f -> %.3f ms' % (_key(r) + (
+                    b['score_ms'], r['score_ms'], b['fm_ms'], r['fm_ms'])))
+    print('%d runs, %d not monotonic (%d known), %d regressions%s' % (
+        len(results), len(failed), len(known), len(regressions),
+        ', written to %s' % args.out if args.out else ''))
+    return 1 if failed or regressions or disagree else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
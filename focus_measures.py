@@ -1,17 +1,236 @@
+import concurrent.futures
+import functools
+import math
+import time
 import cv2
 import numpy as np
 
+# kernels of the differences image minus left, top, right and bottom
+# neighbour (CMSL) and of the second derivatives in x and y (SML)
+_DIFF_KERNELS = (
+    np.array(([0.0, 0.0, 0.0], [-1.0, 1.0, 0.0], [0.0, 0.0, 0.0])),
+    np.array(([0.0, -1.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 0.0])),
+    np.array(([0.0, 0.0, 0.0], [0.0, 1.0, -1.0], [0.0, 0.0, 0.0])),
+    np.array(([0.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, -1.0, 0.0])))
+_LAPLACE_KERNELS = (
+    np.array(([0.0, 0.0, 0.0], [-1.0, 2.0, -1.0], [0.0, 0.0, 0.0])),
+    np.array(([0.0, -1.0, 0.0], [0.0, 2.0, 0.0], [0.0, -1.0, 0.0])))
+
+# number of plans ContrastMeasures.score keeps for reuse
+_MAX_PLANS = 8
+
+# minimum number of rows per strip for parallel evaluation
+_MIN_STRIP_ROWS = 32
+
+# number of pixels filtered at once when evaluating image stacks
+_BATCH_PIXELS = 2**16
+
+# measures with an integer path for uint8 and uint16 images, and the
+# (measure, dtype) which use it by default as it is faster than float
+_INTEGER_MEASURES = ('SML', 'CMSL', 'TENENGRAD1')
+_INTEGER_DEFAULT = (('CMSL', 'uint8'),)
+
+# measures (fm_name, window_size, threshold) MeasureSelector tries
+_SELECT_CANDIDATES = (
+    ('GLV', 3, 0),
+    ('SML', 3, 7),
+    ('CMSL', 3, 7),
+    ('TENENGRAD1', 5, 0),
+    ('TENENGRAD1', 7, 0),
+    ('JAEHNE', 3, 0),
+    ('SPECTRAL', 5, 0))
+
+
+@functools.lru_cache(maxsize=64)
+def _window_weights(n, kernel):
+    """
+    weight of each of the n samples along one axis in the sum over all
+    outputs of a correlation with kernel (tuple) using OpenCV's default
+    border, i.e. sum(filter(x, kernel)) == dot(weights, x)"""
+    r = len(kernel) // 2
+    idx = np.abs(np.arange(n)[:, None] + np.arange(-r, r + 1)[None, :])
+    # reflected as often as needed if the kernel is longer than the axis
+    period = max(2 * (n - 1), 1)
+    idx = idx % period
+    idx = np.where(idx > n - 1, period - idx, idx)
+    w = np.bincount(idx.ravel(), np.tile(kernel, n), minlength=n)
+    w.flags.writeable = False
+    return w
+
+
+def _weighted_mean(e, kernel, scale):
+    """
+    mean of the map that results from filtering the last two axes of the
+    energy e with kernel in x and y and multiplying by scale, computed as
+    a weighted sum without building that map"""
+    h, w = e.shape[-2:]
+    wy = _window_weights(h, tuple(kernel))
+    wx = _window_weights(w, tuple(kernel)).astype(e.dtype)
+    return np.dot(np.dot(e, wx).astype(np.float64), wy) * (scale / (h * w))
+
+
+def _binomial(window_size):
+    """
+    binomial kernel of odd length window_size (1, 2, 1 for 3,
+    1, 4, 6, 4, 1 for 5, ...)"""
+    if window_size < 1 or window_size % 2 == 0:
+        raise ValueError('window_size must be odd: %s' % window_size)
+    n = window_size - 1
+    return np.array([math.comb(n, k) for k in range(window_size)], float)
+
+
+class _Derivatives():
+    """
+    derivative and mean images of one image. If several focus measures are
+    evaluated on the image they are computed once and shared, otherwise
+    they are computed on demand into as few buffers as possible and may be
+    overwritten by the measure (see scratch)
+    """
+
+    def __init__(self, img, fm_names=()):
+        self.img = img
+        self.shared = len(fm_names) > 1
+        # SML derives its Laplacian from the differences if CMSL needs them
+        self._shared_diffs = self.shared and 'CMSL' in fm_names
+        self._cache = {}
+
+    def _get(self, key, func):
+        if not self.shared:
+            return func()
+        if key not in self._cache:
+            self._cache[key] = func()
+        return self._cache[key]
+
+    def scratch(self, a):
+        """a if the measure may overwrite it, else None (for out=)"""
+        return None if self.shared else a
+
+    def _filters(self, kernels):
+        """
+        image filtered with each kernel, all results kept if shared,
+        otherwise one after the other in the same buffer"""
+        if self.shared:
+            return [cv2.filter2D(self.img, cv2.CV_32F, k) for k in kernels]
+        return self._iter_filters(kernels)
+
+    def _iter_filters(self, kernels):
+        buf = None
+        for k in kernels:
+            buf = cv2.filter2D(self.img, cv2.CV_32F, k, dst=buf)
+            yield buf
+
+    def diffs(self):
+        """
+        image minus left, top, right and bottom neighbour
+        (dxb, dyb, dxf, dyf) as used by CMSL"""
+        return self._get('diffs', lambda: self._filters(_DIFF_KERNELS))
+
+    def laplace(self):
+        """
+        second derivatives in x and y (kernel -1, 2, -1) as used by SML,
+        taken from the differences dxb + dxf, dyb + dyf if CMSL is used"""
+        def calc():
+            if self._shared_diffs:
+                dxb, dyb, dxf, dyf = self.diffs()
+                return dxb + dxf, dyb + dyf
+            return self._filters(_LAPLACE_KERNELS)
+        return self._get('laplace', calc)
+
+    def sobel(self):
+        """3x3 Sobel derivatives in x and y"""
+        return self._get('sobel', lambda: (
+                        cv2.Sobel(self.img, cv2.CV_32F, 1, 0, ksize=3),
+                        cv2.Sobel(self.img, cv2.CV_32F, 0, 1, ksize=3)))
+
+    def box_mean(self, window_size):
+        """mean of each window_size x window_size window"""
+        return self._get(('box', window_size), lambda: cv2.boxFilter(
+                                self.img,
+                                cv2.CV_32F,
+                                (window_size, window_size),
+                                normalize=True))
+
+    def binomial_mean(self, window_size):
+        """image smoothed with the binomial kernel of size window_size"""
+        def calc():
+            b = _binomial(window_size)
+            b /= b.sum()
+            return cv2.sepFilter2D(self.img, cv2.CV_32F, b, b)
+        return self._get(('binomial', window_size), calc)
+
+
+def _energy(d, fm_name, window_size, threshold):
+    """
+    per pixel energy of focus measure fm_name (before summing up windows)
+    computed from the derivatives d of the image, in place where d allows.
+    Returns (energy, kernel, scale): the focus map of fm_name equals the
+    energy filtered with kernel in x and y and multiplied by scale"""
+    ones = np.ones(window_size)
+    if fm_name == 'SML':
+        e = np.zeros(d.img.shape, np.float32)
+        for lap in d.laplace():
+            e += np.abs(lap, out=d.scratch(lap))
+        cv2.threshold(e, threshold, 0.0, cv2.THRESH_TOZERO, dst=e)
+        return e, ones, 1.0
+    elif fm_name == 'CMSL':
+        e = np.zeros(d.img.shape, np.float32)
+        for diff in d.diffs():
+            e += np.abs(diff, out=d.scratch(diff))
+        e *= e
+        return e, ones, 1.0 / window_size**2
+    elif fm_name == 'GLV':
+        mean = d.box_mean(window_size)
+        e = np.subtract(d.img, mean, out=d.scratch(mean), dtype=np.float32)
+        e *= e
+        return e, np.ones(1), 1.0
+    elif fm_name == 'TENENGRAD1':
+        gx, gy = d.sobel()
+        e = np.multiply(gx, gx, out=d.scratch(gx))
+        e += np.multiply(gy, gy, out=d.scratch(gy))
+        cv2.threshold(e, threshold, 0.0, cv2.THRESH_TOZERO, dst=e)
+        return e, ones, 1.0
+    elif fm_name == 'JAEHNE':
+        b = _binomial(window_size)
+        mean = d.binomial_mean(window_size)
+        e = np.subtract(d.img, mean, out=d.scratch(mean), dtype=np.float32)
+        e *= e
+        return e, b, 1.0 / b.sum()**2
+    raise ValueError('unknown focus measure: %s' % fm_name)
+
+
+def _stack_to_image(stack, r):
+    """
+    puts the images of a (N, H, W) stack on top of each other, each one
+    padded with r mirrored rows, so that a filter of radius <= r applied
+    to the tall image gives the same rows as applied to each image"""
+    n, h, w = stack.shape
+    tall = np.pad(stack, ((0, 0), (r, r), (0, 0)), mode='reflect')
+    return tall.reshape(n * (h + 2 * r), w)
+
+
+def _image_to_stack(tall, n, r):
+    """inverse of _stack_to_image, drops the padding rows again"""
+    tall = tall.reshape(n, -1, tall.shape[-1])
+    return tall[:, r:tall.shape[1] - r]
+
 
 class ContrastMeasures():
 
-    def __init__(self):
-        pass
+    def __init__(self, workers=1):
+        # compiled measure plans used by score, see plan
+        self._plans = {}
+        # score splits large images into strips for this many threads
+        self.workers = workers
+        self._pool = None
+        self._strip_plans = {}
 
-    def fm(self, img, fm_name, window_size=3, threshold=7):
+    def fm(self, img, fm_name, window_size=3, threshold=7, level=0, stride=1):
         """
         applies focus measure fm_name to input image img
         fm_name must be one of the following:
-        'SML', 'CMSL', 'GLV', 'TENENGRAD1', 'JAEHNE'"""
+        'SML', 'CMSL', 'GLV', 'TENENGRAD1', 'JAEHNE', 'SPECTRAL'
+        level, stride: evaluate at reduced resolution, see reduce"""
+        img = self.reduce(img, level, stride)
         if fm_name == 'SML':
             return self.SML(img, window_size, threshold)
         elif fm_name == 'CMSL':
@@ -22,6 +241,248 @@ class ContrastMeasures():
             return self.tenengrad1(img, window_size, threshold)
         elif fm_name == 'JAEHNE':
             return self.jaehne(img, window_size)
+        elif fm_name == 'SPECTRAL':
+            return self.spectral(img, window_size)
+
+    def reduce(self, img, level=0, stride=1):
+        """
+        reduces the resolution of img for coarse focus searches
+        level: number of image pyramid levels (cv2.pyrDown, each halves
+        width and height). The image is low pass filtered first, so the
+        focus curve gets wider and smoother and its values smaller, while
+        the peak stays at the same lens position. Robust, but the slope
+        near the peak is flatter, so only use it for coarse steps.
+        stride: keep every stride-th row and column. Costs nothing, the
+        derivatives then span stride pixels, so the curve also widens,
+        but fine detail is aliased instead of filtered: the curve gets
+        noisier on fine textures and may show side peaks.
+        Both reduce the work per frame by about (2**level * stride)**2.
+        Window sizes and thresholds apply to the reduced image."""
+        for i in range(level):
+            img = cv2.pyrDown(img)
+        if stride > 1:
+            img = np.ascontiguousarray(img[::stride, ::stride])
+        return img
+
+    def score(self, img, fm_name, window_size=3, threshold=7, level=0,
+              stride=1):
+        """
+        fast path for fm(img, fm_name, window_size, threshold).mean()
+        Only the per pixel energy is computed (in place where possible),
+        each pixel is weighted by the number of windows covering it
+        (borders included) and the weighted sum gives the mean directly,
+        so the windowed focus map is never built.
+        The result agrees with fm(...).mean() to a relative tolerance of
+        1e-5, the difference is float32 rounding of the map and its mean.
+        A MeasurePlan is kept for the last few measure and image shape
+        combinations, so repeated calls allocate nothing.
+        With workers > 1 (see ContrastMeasures(workers)) large images are
+        split into strips that are evaluated in parallel, see
+        _score_parallel.
+        level, stride: evaluate at reduced resolution, see reduce"""
+        img = self.reduce(img, level, stride)
+        if self.workers > 1 and fm_name != 'SPECTRAL' and \
+                img.shape[0] >= self.workers * _MIN_STRIP_ROWS:
+            return self._score_parallel(img, fm_name, window_size, threshold)
+        return self._cached_plan(
+                            fm_name, window_size, threshold,
+                            img.shape, img.dtype).score(img)
+
+    def score_streaming(self, img, fm_name, window_size=3, threshold=7,
+                        band_rows=64):
+        """
+        score of img computed band by band for full resolution frames:
+        the image is processed in horizontal bands of band_rows rows plus
+        the rows the energy depends on above and below, each band adds the
+        weighted sum of its own rows (see MeasurePlan.partial_sum). All
+        bands have the same size and share one MeasurePlan, so the extra
+        memory is a few band sized buffers, no matter how large img is.
+        Same result as score up to float rounding (exact for the integer
+        paths). SPECTRAL needs the whole image and is not split.
+        """
+        if fm_name == 'SPECTRAL':
+            return self.score(img, fm_name, window_size, threshold)
+        h, w = img.shape
+        halo = max(1, window_size // 2)
+        rows = min(h, band_rows + 2 * halo)
+        plan = self._cached_plan(
+                            fm_name, window_size, threshold,
+                            (rows, w), img.dtype)
+        wy = _window_weights(h, plan.kernel)
+        if plan.integer:
+            wy = wy.astype(np.int64)
+        total = 0
+        for a in range(0, h, band_rows):
+            b = min(h, a + band_rows)
+            # fixed band size, at the image border the band is shifted
+            # inwards and mirrors at the border like the whole image does
+            lo = min(max(0, a - halo), h - rows)
+            total += plan.partial_sum(img[lo:lo + rows], a - lo, wy[a:b])
+        return total * (plan.kernel_scale / (h * w))
+
+    def _score_parallel(self, img, fm_name, window_size, threshold):
+        """
+        score on self.workers threads: img is split into horizontal strips
+        that overlap by the rows the energy depends on (halo), each strip
+        has its own MeasurePlan and sums up its own rows with the weights
+        of the whole image, so the partial sums add up to the same score.
+        OpenCV and numpy release the GIL while filtering. OpenCV's own
+        threads are limited to 1 meanwhile, so the cores are not
+        oversubscribed."""
+        h, w = img.shape
+        key = (fm_name, window_size, threshold, img.shape, img.dtype,
+               self.workers)
+        strips = self._strip_plans.get(key)
+        if strips is None:
+            if len(self._strip_plans) >= _MAX_PLANS:
+                self._strip_plans.clear()
+            halo = max(1, window_size // 2)
+            bounds = np.linspace(0, h, self.workers + 1).astype(int)
+            strips = []
+            for a, b in zip(bounds[:-1], bounds[1:]):
+                lo = max(0, a - halo)
+                hi = min(h, b + halo)
+                plan = self.plan(
+                            fm_name, window_size, threshold,
+                            (hi - lo, w), img.dtype)
+                wy = _window_weights(h, plan.kernel)[a:b]
+                if plan.integer:
+                    wy = wy.astype(np.int64)
+                strips.append((plan, lo, hi, a - lo, wy))
+            self._strip_plans[key] = strips
+        if self._pool is None:
+            self._pool = concurrent.futures.ThreadPoolExecutor(self.workers)
+        cv_threads = cv2.getNumThreads()
+        cv2.setNumThreads(1)
+        try:
+            jobs = [self._pool.submit(plan.partial_sum, img[lo:hi], first, wy)
+                    for plan, lo, hi, first, wy in strips]
+            total = sum(job.result() for job in jobs)
+        finally:
+            cv2.setNumThreads(cv_threads)
+        return total * (strips[0][0].kernel_scale / (h * w))
+
+    def fm_tiles(self, img, fm_name, grid=(4, 4), window_size=3, threshold=7):
+        """
+        splits img into a grid (rows, cols) of tiles and returns an array
+        of that shape with the mean focus value of each tile, e.g. for per
+        region focus, tilt detection or choosing an AOI. The focus map is
+        computed once for the whole image (windows at tile borders see the
+        neighbouring tiles) and summed up per tile without python loops.
+        If the image size is not a multiple of the grid, tiles differ in
+        size by one pixel."""
+        h, w = img.shape
+        if not (1 <= grid[0] <= h and 1 <= grid[1] <= w):
+            raise ValueError(
+                    'grid %s does not fit image shape %s' %
+                    (tuple(grid), img.shape))
+        plan = self._cached_plan(
+                            fm_name, window_size, threshold,
+                            img.shape, img.dtype)
+        m = plan.fm(img)
+        h, w = m.shape
+        ys = np.linspace(0, h, grid[0] + 1).astype(int)
+        xs = np.linspace(0, w, grid[1] + 1).astype(int)
+        sums = np.add.reduceat(
+                    np.add.reduceat(m, ys[:-1], axis=0, dtype=np.float64),
+                    xs[:-1],
+                    axis=1)
+        return sums / np.outer(np.diff(ys), np.diff(xs))
+
+    def _cached_plan(self, fm_name, window_size, threshold, shape, dtype):
+        """MeasurePlan from the cache of the last few plans used"""
+        key = (fm_name, window_size, threshold, shape, dtype)
+        plan = self._plans.get(key)
+        if plan is None:
+            if len(self._plans) >= _MAX_PLANS:
+                self._plans.clear()
+            plan = self.plan(fm_name, window_size, threshold, shape, dtype)
+            self._plans[key] = plan
+        return plan
+
+    def plan(self, fm_name, window_size, threshold, shape, dtype=None,
+             integer=None):
+        """
+        returns a MeasurePlan: focus measure fm_name with fixed window_size
+        and threshold for images of shape (rows, cols), with all kernels
+        and buffers allocated once for the per frame loop. With dtype
+        uint8 or uint16 the plan may use the integer path, see
+        MeasurePlan"""
+        return MeasurePlan(
+                        fm_name, window_size, threshold, shape, dtype, integer)
+
+    def integral(self, img, fm_name, threshold=7, max_window=15):
+        """
+        returns an IntegralFocus of img for the box window measures
+        'SML', 'CMSL' and 'TENENGRAD1': the per pixel energy is computed
+        once, after that the mean focus value of any rectangle for any
+        window size up to max_window costs a constant number of lookups"""
+        return IntegralFocus(img, fm_name, threshold, max_window)
+
+    def fm_stack(self, imgs, fm_name, window_size=3, threshold=7):
+        """
+        applies focus measure fm_name to a whole stack of images and
+        returns an array with one value per image, equal to
+        fm(img, fm_name, window_size, threshold).mean()
+        imgs: (N, H, W) array or iterable of equally sized 2-D images
+        Batches of images are filtered as one tall image (padded with
+        mirrored rows in between) and the windowed sums are replaced by a
+        weighted mean of the per pixel energy, so no focus map is built.
+        Batches hold about _BATCH_PIXELS pixels to stay in cache."""
+        return self._stack_scores(imgs, [fm_name], window_size, threshold)[
+                                                                    fm_name]
+
+    def fm_multi(self, img, fm_names, window_size=3, threshold=7):
+        """
+        applies all focus measures in fm_names to img and returns a dict
+        {fm_name: fm(img, fm_name, window_size, threshold).mean()}
+        Difference, Laplacian, Sobel and mean images are computed only
+        once per image and shared between the measures (e.g. SML takes
+        its Laplacian from the differences already computed for CMSL).
+        img may also be a (N, H, W) stack, then each value is an array
+        as returned by fm_stack"""
+        if isinstance(img, np.ndarray) and img.ndim == 2:
+            d = _Derivatives(img, fm_names)
+            scores = {}
+            for fm_name in fm_names:
+                if fm_name == 'SPECTRAL':
+                    scores[fm_name] = self.score(
+                                img, fm_name, window_size, threshold)
+                    continue
+                scores[fm_name] = _weighted_mean(
+                                *_energy(d, fm_name, window_size, threshold))
+            return scores
+        return self._stack_scores(img, fm_names, window_size, threshold)
+
+    def _stack_scores(self, imgs, fm_names, window_size, threshold):
+        """
+        mean values of all measures in fm_names for a stack of images,
+        see fm_stack. Returns a dict {fm_name: array of N values}"""
+        if not isinstance(imgs, np.ndarray):
+            imgs = list(imgs)
+        stack = np.asarray(imgs)
+        if stack.ndim == 2:
+            stack = stack[np.newaxis]
+        n, h, w = stack.shape
+        # rows the energy of each measure depends on above and below
+        r = max(1, window_size // 2)
+        batch = max(1, _BATCH_PIXELS // (h * w))
+        scores = dict((fm_name, np.empty(n)) for fm_name in fm_names)
+        for i in range(0, n, batch):
+            d = _Derivatives(
+                            _stack_to_image(stack[i:i + batch], r),
+                            fm_names)
+            for fm_name in fm_names:
+                if fm_name == 'SPECTRAL':
+                    # the spectrum of the tall image is no use
+                    scores[fm_name][i:i + batch] = [
+                                self.score(f, fm_name, window_size, threshold)
+                                for f in stack[i:i + batch]]
+                    continue
+                e, kernel, scale = _energy(d, fm_name, window_size, threshold)
+                e = _image_to_stack(e, len(e) // (h + 2 * r), r)
+                scores[fm_name][i:i + batch] = _weighted_mean(e, kernel, scale)
+        return scores
 
     def CMSL(self, img, window):
         """
@@ -101,23 +562,534 @@ class ContrastMeasures():
                                 normalize=False)
 
     def jaehne(self, img, window_size):
-        """Only implemented for window_size 3 or 5 according to
+        """
+        according to
         'Entwicklung einer fokusbasierenden Hoehenmessung mit
         dem "Depth from Focus"-Verfahren' by Dunck
+        window_size: any odd size, the binomial kernels are applied as
+        separable 1-D passes, so the cost grows linearly with window_size
+        """
+        kernel = _binomial(window_size)
+        kernel /= kernel.sum()
+        img_t = (img - cv2.sepFilter2D(img, cv2.CV_32F, kernel, kernel))**2
+        return cv2.sepFilter2D(img_t, -1, kernel, kernel)
+
+    def spectral(self, img, window_size):
+        """
+        high frequency energy of the spectrum: the image (minus its mean,
+        Hann windowed) is transformed with a DFT of optimal size and the
+        power of all frequencies with a period shorter than window_size
+        pixels is summed up. On textured scenes the curve is sharper and
+        more unimodal than for the gradient measures. Padded buffers,
+        window and frequency mask are cached per AOI shape (MeasurePlan).
+        Returns the squared high pass filtered image as focus map. If the
+        AOI had to be padded its mean is slightly below score(img,
+        'SPECTRAL', ...), which also counts the energy that leaks into
+        the padding"""
+        plan = self._cached_plan(
+                            'SPECTRAL', window_size, 0, img.shape, img.dtype)
+        return plan.fm(img).copy()
+
+
+class MeasurePlan():
+    """
+    focus measure fm_name with fixed window_size and threshold, compiled for
+    images of one shape (rows, cols): kernels, window weights and buffers
+    are created once, so evaluating a frame in the AF loop allocates no
+    image sized arrays. CMSL and SML take the differences of neighbouring
+    pixels by slicing a padded copy of the image instead of filtering
+    with 3x3 kernels. Create plans with ContrastMeasures.plan.
+    If dtype is uint8 or uint16, SML, CMSL and TENENGRAD1 can be computed
+    with integers (derivatives in int16/int32, energies in int32/int64 for
+    uint8/uint16 images) and the weighted sum is exact, so score is the
+    exact value the float path approximates (to about 1e-6 relative).
+    integer: True for the integer path, False for the float path, None
+    for the faster one (integers only for CMSL on uint8 images).
+    A plan is not thread safe, use one plan per thread.
+    """
+
+    def __init__(self, fm_name, window_size, threshold, shape, dtype=None,
+                 integer=None):
+        if fm_name not in (
+                'SML', 'CMSL', 'GLV', 'TENENGRAD1', 'JAEHNE', 'SPECTRAL'):
+            raise ValueError('unknown focus measure: %s' % fm_name)
+        self.fm_name = fm_name
+        self.window_size = window_size
+        self.threshold = threshold
+        self.shape = tuple(shape)
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        h, w = self.shape
+        # types of derivatives and energy
+        dt = et = np.float32
+        if integer is None:
+            integer = self.dtype is not None and \
+                (fm_name, self.dtype.name) in _INTEGER_DEFAULT
+        self.integer = integer and fm_name in _INTEGER_MEASURES and \
+            self.dtype in (np.uint8, np.uint16)
+        if self.integer and self.dtype == np.uint8:
+            dt, et = np.int16, np.int32
+        elif self.integer:
+            dt, et = np.int32, np.int64
+        self._energy = np.empty(self.shape, et)
+        self._tmp = np.empty(self.shape, et)
+        self._map = np.empty(self.shape, np.float32)
+        self._rows = np.empty(h, np.float32)
+        if fm_name in ('SML', 'CMSL', 'TENENGRAD1'):
+            # derivatives
+            self._grad = np.empty(self.shape, dt)
+            self._grad2 = np.empty(self.shape, dt)
+        if fm_name in ('SML', 'CMSL') or \
+                (fm_name == 'TENENGRAD1' and self.integer and
+                 self.dtype == np.uint16):
+            # padded image and differences of neighbouring pixels
+            self._pad = np.empty((h + 2, w + 2), dt)
+            self._dx = np.empty((h, w + 1), dt)
+            self._dy = np.empty((h + 1, w), dt)
+        kernel = np.ones(window_size)
+        scale = 1.0
+        if fm_name == 'CMSL':
+            scale = 1.0 / window_size**2
+        elif fm_name == 'GLV':
+            kernel = np.ones(1)
+        elif fm_name == 'JAEHNE':
+            kernel = _binomial(window_size)
+            scale = 1.0 / kernel.sum()**2
+            self._kernel1d = kernel / kernel.sum()
+        elif fm_name == 'SPECTRAL':
+            # window_size is the cut-off period, not a window
+            kernel = np.ones(1)
+            self._init_spectral()
+        self.kernel = tuple(kernel)
+        self.kernel_scale = scale
+        self._wy = _window_weights(h, self.kernel)
+        self._wx = _window_weights(w, self.kernel).astype(np.float32)
+        self._scale = scale / (h * w)
+        if self.integer:
+            # column weights are kernel.sum() except near the border
+            self._mask = np.empty(self.shape, bool)
+            self._rows64 = np.empty(h, np.int64)
+            wx = self._wx.astype(np.int64)
+            self._wx_inner = int(kernel.sum())
+            self._wx_idx = np.nonzero(wx != self._wx_inner)[0]
+            self._wx_dev = wx[self._wx_idx] - self._wx_inner
+            self._wy_int = self._wy.astype(np.int64)
+
+    def _init_spectral(self):
+        """
+        DFT buffers of optimal size (zero padded), Hann window and the
+        mask of all frequencies with a period < window_size pixels"""
+        h, w = self.shape
+        dh = cv2.getOptimalDFTSize(h)
+        dw = cv2.getOptimalDFTSize(w)
+        self._dft_in = np.zeros((dh, dw), np.float32)
+        self._dft_out = np.empty((dh, dw, 2), np.float32)
+        # inverse DFT of fm, kept apart so the zero padding of _dft_in
+        # stays zero
+        self._idft_out = np.empty((dh, dw), np.float32)
+        self._hann = np.outer(np.hanning(h), np.hanning(w)).astype(np.float32)
+        freq = np.hypot(np.fft.fftfreq(dh)[:, None], np.fft.fftfreq(dw))
+        self._freq_mask = (freq > 1.0 / self.window_size).astype(np.float32)
+        # the same for real and imaginary part of the DFT output
+        self._power_mask = np.repeat(self._freq_mask.ravel(), 2)
+        self._dft_scale = 1.0 / (dh * dw * h * w)
+
+    def _spectrum(self, img):
+        h, w = self.shape
+        a = self._dft_in[:h, :w]
+        np.subtract(img, cv2.mean(img)[0], out=a, dtype=np.float32)
+        a *= self._hann
+        return cv2.dft(
+                        self._dft_in,
+                        self._dft_out,
+                        flags=cv2.DFT_COMPLEX_OUTPUT)
+
+    def score(self, img):
+        """
+        mean of the focus map of img, same as ContrastMeasures.score"""
+        if self.fm_name == 'SPECTRAL':
+            self._check(img)
+            f = self._spectrum(img)
+            # Parseval: sum of the power of the masked frequencies
+            f *= f
+            return float(np.dot(f.ravel(), self._power_mask)) * \
+                self._dft_scale
+        e = self._compute_energy(img)
+        if self.integer:
+            return self._weighted_sum(e, self._wy_int) * self._scale
+        return self._weighted_sum(e, self._wy) * self._scale
+
+    def partial_sum(self, img, first, wy):
+        """
+        weighted energy sum of the rows first:first + len(wy) of img with
+        the row weights wy (int64 for integer plans) and the column weights
+        of the plan. With the row weights of a larger image, the sums of
+        overlapping strips of that image add up to its weighted sum"""
+        e = self._compute_energy(img)
+        return self._weighted_sum(e[first:first + len(wy)], wy)
+
+    def _weighted_sum(self, e, wy):
+        n = len(e)
+        if self.integer:
+            rows = e.sum(axis=1, dtype=np.int64, out=self._rows64[:n])
+            rows *= self._wx_inner
+            rows += np.dot(e[:, self._wx_idx], self._wx_dev)
+            return int(np.dot(rows, wy))
+        np.dot(e, self._wx, out=self._rows[:n])
+        return float(np.dot(self._rows[:n], wy))
+
+    def fm(self, img):
+        """
+        focus map of img, same as ContrastMeasures.fm. The returned array
+        is reused by the next call, copy it to keep it"""
+        if self.fm_name == 'SPECTRAL':
+            self._check(img)
+            f = self._spectrum(img)
+            f *= self._freq_mask[:, :, np.newaxis]
+            cv2.idft(
+                    f,
+                    self._idft_out,
+                    flags=cv2.DFT_SCALE | cv2.DFT_REAL_OUTPUT)
+            np.square(self._idft_out[:self.shape[0], :self.shape[1]],
+                      out=self._map)
+            return self._map
+        e = self._compute_energy(img)
+        w = self.window_size
+        if self.integer:
+            self._map[...] = e
+            e = self._map
+        if self.fm_name == 'GLV':
+            return e
+        elif self.fm_name == 'JAEHNE':
+            k = self._kernel1d
+            return cv2.sepFilter2D(e, -1, k, k, dst=self._map)
+        return cv2.boxFilter(
+                                e,
+                                -1,
+                                (w, w),
+                                dst=self._map,
+                                normalize=self.fm_name == 'CMSL')
+
+    def _pad_diffs(self, img):
+        """
+        copies img into the padded buffer (mirrored border like OpenCV)
+        and stores right minus left neighbour in _dx, bottom minus top
+        neighbour in _dy. Pixel x lies between _dx[:, x] and _dx[:, x+1]"""
+        p = self._pad
+        p[1:-1, 1:-1] = img
+        # a single row or column is its own mirror image
+        kx = 2 if self.shape[1] > 1 else 1
+        ky = 2 if self.shape[0] > 1 else 1
+        p[1:-1, 0] = p[1:-1, kx]
+        p[1:-1, -1] = p[1:-1, -1 - kx]
+        p[0] = p[ky]
+        p[-1] = p[-1 - ky]
+        np.subtract(p[1:-1, 1:], p[1:-1, :-1], out=self._dx)
+        np.subtract(p[1:, 1:-1], p[:-1, 1:-1], out=self._dy)
+        return self._dx, self._dy
+
+    def _sobel(self, img):
+        """
+        3x3 Sobel derivatives into _grad and _grad2: OpenCV for float
+        and uint8 images, slicing the padded image for uint16 (OpenCV has
+        no integer Sobel output for uint16 input)"""
+        gx = self._grad
+        gy = self._grad2
+        if not self.integer:
+            cv2.Sobel(img, cv2.CV_32F, 1, 0, dst=gx, ksize=3)
+            cv2.Sobel(img, cv2.CV_32F, 0, 1, dst=gy, ksize=3)
+        elif self.dtype == np.uint8:
+            cv2.Sobel(img, cv2.CV_16S, 1, 0, dst=gx, ksize=3)
+            cv2.Sobel(img, cv2.CV_16S, 0, 1, dst=gy, ksize=3)
+        else:
+            self._pad_diffs(img)
+            p = self._pad
+            # central differences right - left, smoothed 1, 2, 1 in y
+            np.subtract(p[:-2, 2:], p[:-2, :-2], out=gx)
+            gx += p[2:, 2:]
+            gx -= p[2:, :-2]
+            np.subtract(p[1:-1, 2:], p[1:-1, :-2], out=gy)
+            gx += gy
+            gx += gy
+            np.subtract(p[2:, :-2], p[:-2, :-2], out=gy)
+            gy += p[2:, 2:]
+            gy -= p[:-2, 2:]
+            # bottom - top in the middle column, counted twice
+            gy += self._dy[1:]
+            gy += self._dy[:-1]
+            gy += self._dy[1:]
+            gy += self._dy[:-1]
+        return gx, gy
+
+    def _threshold(self, e):
+        # energies are >= 0, so a threshold <= 0 changes nothing
+        if self.threshold <= 0:
+            return
+        if self.integer:
+            np.less_equal(e, self.threshold, out=self._mask)
+            np.copyto(e, 0, where=self._mask)
+        else:
+            cv2.threshold(e, self.threshold, 0.0, cv2.THRESH_TOZERO, dst=e)
+
+    def _check(self, img):
+        if img.shape != self.shape:
+            raise ValueError(
+                    'image shape %s does not match plan shape %s' %
+                    (img.shape, self.shape))
+        if self.integer and img.dtype != self.dtype:
+            raise ValueError(
+                    'image type %s does not match plan type %s' %
+                    (img.dtype, self.dtype))
+
+    def _compute_energy(self, img):
+        self._check(img)
+        e = self._energy
+        t = self._tmp
+        if self.fm_name == 'SML':
+            dx, dy = self._pad_diffs(img)
+            g = self._grad
+            # 2*I - left - right = (I - left) - (right - I)
+            np.subtract(dx[:, :-1], dx[:, 1:], out=g)
+            np.abs(g, out=g)
+            np.subtract(dy[:-1], dy[1:], out=self._grad2)
+            np.abs(self._grad2, out=self._grad2)
+            g += self._grad2
+            # the modified Laplacian fits the derivative type
+            e = g
+            self._threshold(e)
+        elif self.fm_name == 'CMSL':
+            dx, dy = self._pad_diffs(img)
+            g = self._grad
+            np.abs(dx, out=dx)
+            np.abs(dy, out=dy)
+            # |I - left| + |I - right| + |I - top| + |I - bottom|
+            np.add(dx[:, :-1], dx[:, 1:], out=g)
+            g += dy[:-1]
+            g += dy[1:]
+            np.multiply(g, g, out=e, dtype=e.dtype)
+        elif self.fm_name == 'GLV':
+            w = self.window_size
+            cv2.boxFilter(img, cv2.CV_32F, (w, w), dst=t, normalize=True)
+            np.subtract(img, t, out=e, dtype=np.float32)
+            e *= e
+        elif self.fm_name == 'TENENGRAD1':
+            gx, gy = self._sobel(img)
+            np.multiply(gx, gx, out=e, dtype=e.dtype)
+            np.multiply(gy, gy, out=t, dtype=t.dtype)
+            e += t
+            self._threshold(e)
+        elif self.fm_name == 'JAEHNE':
+            k = self._kernel1d
+            cv2.sepFilter2D(img, cv2.CV_32F, k, k, dst=t)
+            np.subtract(img, t, out=e, dtype=np.float32)
+            e *= e
+        return e
+
+
+class IntegralFocus():
+    """
+    summed area table backend for the box window measures SML, CMSL and
+    TENENGRAD1. The energy of the whole image is integrated twice, so that
+    score(aoi, window_size) == fm(img, fm_name, window_size, threshold)
+    [y1:y2, x1:x2].mean() is answered from 16 table lookups, for any AOI
+    and any odd window_size <= max_window.
+    Note this is the focus map of the whole image averaged over the AOI,
+    at the AOI border it differs slightly from the map of the cropped AOI.
+    The tables use 8 bytes per pixel each. For integer images they are
+    int64 and exact (wrap around cancels), otherwise float64.
+    """
+
+    def __init__(self, img, fm_name, threshold=7, max_window=15):
+        if fm_name not in ('SML', 'CMSL', 'TENENGRAD1'):
+            raise ValueError(
+                    'no box window focus measure: %s' % fm_name)
+        self.fm_name = fm_name
+        self.threshold = threshold
+        self.max_window = max_window
+        self.shape = img.shape[:2]
+        e, kernel, scale = _energy(_Derivatives(img), fm_name, 1, threshold)
+        # mirror the energy like cv2.boxFilter does at the image border
+        r = max_window // 2
+        e = cv2.copyMakeBorder(e, r, r, r, r, cv2.BORDER_REFLECT_101)
+        if np.issubdtype(img.dtype, np.integer):
+            e = e.astype(np.int64)
+        else:
+            e = e.astype(np.float64)
+        # table of the integral image: _table[y, x] = sum over y' < y,
+        # x' < x of the integral image I, where I[y, x] sums e[:y, :x]
+        h, w = e.shape
+        self._table = np.zeros((h + 2, w + 2), e.dtype)
+        np.cumsum(e, axis=0, out=e)
+        np.cumsum(e, axis=1, out=e)
+        np.cumsum(e, axis=0, out=self._table[2:, 2:])
+        np.cumsum(self._table[2:, 2:], axis=1, out=self._table[2:, 2:])
+        self._pad = r
+
+    def score(self, aoi, window_size):
+        """
+        mean focus value in aoi [x1, y1, x2, y2] for window_size"""
+        return float(self.scores([aoi], window_size)[0])
+
+    def scores(self, aois, window_sizes):
+        """
+        mean focus values for a list of aois [x1, y1, x2, y2]. window_sizes
+        is one window size or one per aoi. Returns an array"""
+        aois = np.asarray(aois, dtype=np.int64).reshape(-1, 4)
+        window_sizes = np.broadcast_to(
+                                np.asarray(window_sizes, dtype=np.int64),
+                                len(aois))
+        if window_sizes.max() > self.max_window:
+            raise ValueError(
+                    'window_size larger than max_window %d' % self.max_window)
+        x1, y1, x2, y2 = (aois + self._pad).T
+        r = window_sizes // 2
+        t = self._table
+
+        def windows(y, x):
+            # sum of the integral image over all window positions around y, x
+            return t[y + r + 1, x + r + 1] - t[y - r, x + r + 1] - \
+                t[y + r + 1, x - r] + t[y - r, x - r]
+
+        total = windows(y2, x2) - windows(y1, x2) - \
+            windows(y2, x1) + windows(y1, x1)
+        scale = 1.0
+        if self.fm_name == 'CMSL':
+            scale = 1.0 / window_sizes**2
+        return total * scale / ((x2 - x1) * (y2 - y1))
+
+
+class DepthFromFocus():
+    """
+    streaming depth from focus for sweeps: feed one image per lens position
+    with update(img, position). Per pixel only the best focus value, the
+    lens position it occurred at and the pixel value at that position are
+    kept, so memory is O(H*W) no matter how many images the sweep has.
+    depth_map() and all_in_focus() return the results
+    """
+
+    def __init__(self, fm_name='SML', window_size=5, threshold=7):
+        self.fm_name = fm_name
+        self.window_size = window_size
+        self.threshold = threshold
+        self.count = 0
+        self.best_score = None
+        self._plan = None
+        self._depth = None
+        self._best_pixel = None
+        self._better = None
+
+    def update(self, img, position):
+        """adds image img taken at lens position position"""
+        if self._plan is None:
+            self._plan = MeasurePlan(
+                                self.fm_name,
+                                self.window_size,
+                                self.threshold,
+                                img.shape)
+            self.best_score = self._plan.fm(img).copy()
+            self._depth = np.full(img.shape, position, np.float32)
+            self._best_pixel = img.copy()
+            self._better = np.empty(img.shape, bool)
+        else:
+            m = self._plan.fm(img)
+            np.greater(m, self.best_score, out=self._better)
+            np.copyto(self.best_score, m, where=self._better)
+            self._depth[self._better] = position
+            np.copyto(self._best_pixel, img, where=self._better)
+        self.count += 1
+
+    def depth_map(self):
+        """
+        lens position of the best focus value for each pixel. Where
+        best_score is (close to) 0 there is no texture and the depth is
+        not reliable"""
+        return self._depth
+
+    def all_in_focus(self):
+        """image composed of each pixel at its sharpest lens position"""
+        return self._best_pixel
+
+
+def curve_quality(values, tolerance=0.02):
+    """
+    quality of a focus curve sampled at increasing lens positions, returns
+    (sharpness, contrast, unimodal):
+    sharpness: 1 - mean of the curve scaled to [0, 1], 1 for a single
+    peak sample, 0.5 for a ramp, 0 for a flat curve
+    contrast: (max - min) / max
+    unimodal: the curve rises to a single maximum and falls after it,
+    changes below tolerance * (max - min) are taken as noise"""
+    v = np.asarray(values, np.float64)
+    top = v.max()
+    span = top - v.min()
+    if top <= 0 or span <= 0:
+        return 0.0, 0.0, False
+    sharpness = 1.0 - ((v - v.min()) / span).mean()
+    d = np.diff(v)
+    signs = np.sign(d[np.abs(d) > tolerance * span])
+    changes = np.count_nonzero(signs[1:] != signs[:-1])
+    unimodal = changes == 0 or (changes == 1 and signs[0] > 0)
+    return float(sharpness), float(span / top), bool(unimodal)
+
+
+class MeasureSelector():
+    """
+    picks the focus measure for an AOI and scene: select(frames, key) is
+    given a few images taken at increasing lens positions across the
+    focus range (a short probe sweep), times every candidate measure on
+    them and rates its focus curve with curve_quality. The cheapest
+    measure whose curve is unimodal and reaches min_sharpness and
+    min_contrast wins; if none does, the best curve wins regardless of
+    cost. The choice is cached per key (scene name, AOI, ...), so later
+    runs skip the probe. The cost is the best of repeat timed passes
+    """
+
+    def __init__(self, candidates=_SELECT_CANDIDATES, min_sharpness=0.5,
+                 min_contrast=0.3, measures=None, repeat=3):
+        self.candidates = tuple(candidates)
+        self.repeat = repeat
+        self.min_sharpness = min_sharpness
+        self.min_contrast = min_contrast
+        self.fm = ContrastMeasures() if measures is None else measures
+        # per candidate: (measure, seconds per frame, sharpness, contrast,
+        # unimodal) of the last probe
+        self.results = []
+        self._choice = {}
+
+    def cached(self, key):
+        """measure chosen for key or None if key was not probed yet"""
+        return self._choice.get(key)
+
+    def forget(self, key=None):
+        """drops the choice for key (all choices for key=None)"""
+        if key is None:
+            self._choice.clear()
+        else:
+            self._choice.pop(key, None)
+
+    def select(self, frames, key=None):
         """
-        if window_size == 3:
-            kernel = np.array([
-                            [1.0, 2.0, 1.0],
-                            [2.0, 4.0, 2.0],
-                            [1.0, 2.0, 1.0]])
-            sum = 16
-        elif window_size == 5:
-            kernel = np.array([
-                            [1.0, 4.0, 6.0, 4.0, 1.0],
-                            [4.0, 16.0, 24.0, 16.0, 4.0],
-                            [6.0, 24.0, 36.0, 24.0, 6.0],
-                            [4.0, 16.0, 24.0, 16.0, 4.0],
-                            [1.0, 4.0, 6.0, 4.0, 1.0]])
-            sum = 256
-        img_t = (img - cv2.filter2D(img, cv2.CV_32F, kernel) / sum)**2
-        return cv2.filter2D(img_t, -1, kernel) / sum
+        returns the measure (fm_name, window_size, threshold) for the probe
+        images frames, taken at increasing lens positions. If key was
+        probed before the cached choice is returned and frames is not
+        used"""
+        if key is not None and key in self._choice:
+            return self._choice[key]
+        self.results = []
+        for measure in self.candidates:
+            # first call creates the plan, it is not timed
+            self.fm.score(frames[0], *measure)
+            cost = float('inf')
+            for _ in range(self.repeat):
+                t = time.perf_counter()
+                values = [self.fm.score(img, *measure) for img in frames]
+                cost = min(cost, (time.perf_counter() - t) / len(frames))
+            self.results.append((measure, cost) + curve_quality(values))
+        good = [r for r in self.results if r[4] and
+                r[2] >= self.min_sharpness and r[3] >= self.min_contrast]
+        if good:
+            choice = min(good, key=lambda r: r[1])[0]
+        else:
+            choice = max(self.results, key=lambda r: (r[4], r[2] * r[3]))[0]
+        if key is not None:
+            self._choice[key] = choice
+        return choice
@@ -3,10 +3,158 @@
 
 import time
 import sys
+import queue
+import threading
+import functools
 import cv2
+import numpy as np
 from focus_measures import ContrastMeasures
+
+# golden section ratio (3-sqrt(5))/2 of brent_peak
+_GOLDEN=0.3819660112501051
+# size of the thumbnails ScoreCache compares and the defocus (gaussian sigma in aoi pixels)
+# it tries to undo between them
+_THUMB=32
+_THUMB_BLUR=(0,2,4,8,16,32,64)
+
+class ScoreCache:
+  # session cache of fm values for the searches (their cache argument), key: theoretical lense
+  # position, approach direction, aoi and measure (fm_name,window_size,threshold,level)
+  # the theoretical position is where the lense is after compensating hysteresis: moved to
+  # x+hysteresis forward or x-hysteresis backward, the lense is at x. Searches moving the lense
+  # without compensation store the position minus the hysteresis of the direction
+  # searches consult it before moving the lense and grabbing, known positions cost nothing
+  # ttl: entries expire after ttl seconds (None: never)
+  # clock: function returning the time in s, e.g. the clock of a simulated lense
+  # min_similarity: check_scene clears the cache when the similarity of a thumbnail of the aoi
+  #	with the one of the last check is below min_similarity (scene changed)
+  def __init__(self,ttl=None,clock=time.monotonic,min_similarity=0.8):
+  	self.ttl=ttl
+  	self.clock=clock
+  	self.min_similarity=min_similarity
+  	self.hits=0
+  	self.misses=0
+  	self._values={}		#key: (fm value,time)
+  	self._thumbs={}		#aoi: thumbnail of the last check
+  	
+  def _key(self,position,direction,aoi,measure):
+  	return (position,direction,tuple(aoi),tuple(measure))
+  	
+  def get(self,position,direction,aoi,measure):
+  	# cached fm value or None
+  	key=self._key(position,direction,aoi,measure)
+  	entry=self._values.get(key)
+  	if entry is not None and self.ttl is not None and self.clock()-entry[1]>self.ttl:
+  		del self._values[key]	#expired
+  		entry=None
+  	if entry is None:
+  		self.misses+=1
+  		return None
+  	self.hits+=1
+  	return entry[0]
+  	
+  def put(self,position,direction,aoi,measure,value):
+  	self._values[self._key(position,direction,aoi,measure)]=(value,self.clock())
+  	
+  def clear(self):
+  	self._values.clear()
+  	self._thumbs.clear()
+  	
+  def __len__(self):
+  	return len(self._values)
+  	
+  def check_scene(self,img,aoi):
+  	# compares img (the aoi) with the last checked image of aoi, clears the cache if the scene
+  	# changed. img may be taken at any lense position, see similarity
+  	# returns True if the scene is unchanged
+  	t=cv2.resize(img.astype(np.float32),(_THUMB,_THUMB),interpolation=cv2.INTER_AREA)
+  	key=tuple(aoi)
+  	old=self._thumbs.get(key)
+  	self._thumbs[key]=t
+  	if old is None:
+  		return True
+  	if self.similarity(old,t,img.shape)<self.min_similarity:
+  		self.clear()
+  		self._thumbs[key]=t
+  		return False
+  	return True
+  	
+  @staticmethod
+  def similarity(a,b,shape):
+  	# similarity of the thumbnails a and b of an aoi of shape (rows,cols) taken at different
+  	# lense positions: the correlation after blurring the sharper one like the other by the
+  	# best of the gaussians _THUMB_BLUR, without the border the blur mixes with the outside
+  	# of the aoi. 1: same scene, about 0 for another scene. Heavily blurred thumbnails (sigma
+  	# of the size of the aoi) carry little information, they may match other scenes as well
+  	h,w=shape
+  	flat=(np.ptp(a)==0,np.ptp(b)==0)
+  	if any(flat):			#nothing to compare: same scene only if both are flat
+  		return 1.0 if all(flat) else 0.0
+  	best=-1.0
+  	for sigma in _THUMB_BLUR:
+  		sx=sigma*_THUMB/float(w)
+  		sy=sigma*_THUMB/float(h)
+  		mx=min(int(sx),_THUMB//4)
+  		my=min(int(sy),_THUMB//4)
+  		for x,y in ((a,b),(b,a)):
+  			if sigma:
+  				x=cv2.GaussianBlur(x,(0,0),sx,sigmaY=sy)
+  			x=x[my:_THUMB-my,mx:_THUMB-mx].ravel()
+  			y=y[my:_THUMB-my,mx:_THUMB-mx].ravel()
+  			x=x-x.mean()
+  			y=y-y.mean()
+  			norm=np.linalg.norm(x)*np.linalg.norm(y)
+  			if norm>0:
+  				best=max(best,float(np.dot(x,y))/norm)
+  	return best
+  	
+  def check(self,cam,aoi):
+  	# check_scene with an image grabbed at the current lense position
+  	return self.check_scene(cam.GrabOne(1000).Array[aoi[1]:aoi[3],aoi[0]:aoi[2]],aoi)
+
+def _direction(x,current):
+  # approach direction of a move from current to x: 1 forward, -1 backward, 0 no move
+  return (x>current)-(x<current)
+
+class _Probe:
+  # grabs and scores lense positions for the searches, every position at most once
+  # moves are compensated for hysteresis like in fibonacci_peak
+  # cache: optional ScoreCache, consulted before moving the lense
+  def __init__(self,cam,focus,aoi,hysteresis,measure,cache=None):
+  	self.cam=cam
+  	self.focus=focus
+  	self.aoi=aoi
+  	self.hysteresis=hysteresis
+  	self.measure=measure
+  	self.fm=ContrastMeasures()
+  	self.seen={}				#fm values of the positions visited so far
+  	self.goto=focus.get_position()	#last theoretical position
+  	self.n=0					#number of images grabbed
+  	self.cache=cache
+  	self.key=tuple(measure)+(0,)
+  	if cache is not None:
+  		cache.check(cam,aoi)
+  		self.n+=1
+  	
+  def __call__(self,x):
+  	if x not in self.seen:
+  		d=_direction(x,self.goto)
+  		if self.cache is not None:
+  			self.seen[x]=self.cache.get(x,d,self.aoi,self.key)
+  			if self.seen[x] is not None:	#known, the lense stays where it is
+  				return self.seen[x]
+  		offset=self.hysteresis if x>self.goto else -1*self.hysteresis
+  		if x!=self.goto:
+  			self.focus.go_to_position(x+offset)
+  		self.goto=x
+  		img=self.cam.GrabOne(1000).Array[self.aoi[1]:self.aoi[3],self.aoi[0]:self.aoi[2]]
+  		self.seen[x]=self.fm.score(img,*self.measure)
+  		self.n+=1
+  		if self.cache is not None:
+  			self.cache.put(x,d,self.aoi,self.key,self.seen[x])
+  	return self.seen[x]
 		
-def fibonacci_peak(cam,focus,ak,bk,aoi,hysteresis,tolerance):
+def fibonacci_peak(cam,focus,ak,bk,aoi,hysteresis,tolerance,measure=None,cache=None):
   """Fibonacci peak search taken from E. Krotkov: "Focusing" P.233"""
   #	cam: camera already opened
   #	focus: focus from used LenseController
@@ -15,16 +163,45 @@ def fibonacci_peak(cam,focus,ak,bk,aoi,hysteresis,tolerance):
   #	aoi: area of interest in form [x1,y1,x2,y2]
   #	hysteresis: offset to compensate hysteresis
   #	tolerance: tolerance limit, algorithm stops when the search interval becomes smaller than tolerance
+  #	measure: focus measure (fm_name,window_size,threshold), e.g. from select_measure
+  #	cache: optional ScoreCache, consulted before moving the lense
   
   which=0
   N=fibonacci(bk)[1]	#calculate theoretical number of loops needed for peak finding
   nCount=0			#variable to count actual number of loops used
   dir=1				#indicates lense's step direction, 1: step forward, 0: step backward
   					#(needed to compensate lense hysteresis depending on move direction)
-  goto=0				#saves last position to detect move direction
+  goto=focus.get_position()	#saves last position to detect move direction
   offset=0			#offset to add to actual position to compensate hysteresis, offset is 
   					#either =hysteresis or 0-1*hysteresis depending on step direction
+  if measure is None:
+  	measure=('TENENGRAD1',5,0)
   fm = ContrastMeasures()
+  key=tuple(measure)+(0,)
+  if cache is not None:
+  	cache.check(cam,aoi)
+  def fm_at(x,compensate=True):
+  	#fm value of theoretical position x, on a cache hit the lense stays where it is, so goto,
+  	#dir and offset only follow the moves actually made
+  	nonlocal goto,dir,offset
+  	if x>goto:				#determine moving direction, depending on direction, determine offset
+  		new_dir,new_offset=1,hysteresis
+  	else:
+  		new_dir,new_offset=0,-1*hysteresis
+  	pos=x+new_offset if compensate else x	#actual position = theoretical position + offset
+  	d=_direction(pos,focus.get_position())
+  	cx=x if compensate else x-d*hysteresis	#cache key: where the lense is, see ScoreCache
+  	y=None if cache is None else cache.get(cx,d,aoi,key)
+  	if y is None:
+  		focus.go_to_position(pos)	#move lense
+  		img=cam.GrabOne(1000).Array[aoi[1]:aoi[3],aoi[0]:aoi[2]]	#grab image
+  		y=fm.score(img,*measure)	#calculate contrast
+  		if cache is not None:
+  			cache.put(cx,d,aoi,key,y)
+  		goto=x					#save theoretical position
+  		if compensate:
+  			dir,offset=new_dir,new_offset
+  	return y
   for k in range(1,N+1):
   	nCount+=1		#count loops
   	
@@ -37,45 +214,16 @@ def fibonacci_peak(cam,focus,ak,bk,aoi,hysteresis,tolerance):
   	
   	if k==1:						#first interval, lense always moves forward
   		x1k=int(round(ak+Ik))
-  		focus.go_to_position(x1k)
-  		img=cam.GrabOne(1000).Array[aoi[1]:aoi[3],aoi[0]:aoi[2]]
-  		y1k=fm.fm(img,'TENENGRAD1',5,0).mean()
+  		y1k=fm_at(x1k,False)
   		x2k=int(round(bk-Ik))
-  		focus.go_to_position(x2k)
-  		img=cam.GrabOne(1000).Array[aoi[1]:aoi[3],aoi[0]:aoi[2]]
-  		y2k=fm.fm(img,'TENENGRAD1',5,0).mean()
-  		goto=x2k
+  		y2k=fm_at(x2k,False)
   		
   	elif which==1:
   		x1k=int(round(ak+Ik))		#calculate next position
-  		
-  		if x1k>goto:				#determine moving direction, depending on direction, determine offset
-  			dir=1
-  			offset=hysteresis		
-  		else:
-  			dir=0
-  			offset=-1*hysteresis
-  		goto=x1k					#save theoretical position
-  		
-  		pos=x1k+offset				#actual position = theoretical position + offset
-  		focus.go_to_position(pos)	#move lense
-  		img=cam.GrabOne(1000).Array[aoi[1]:aoi[3],aoi[0]:aoi[2]]	#grab image
-  		y1k=fm.fm(img,'TENENGRAD1',5,0).mean()	#calculate contrast
+  		y1k=fm_at(x1k)				#move lense, grab image and calculate contrast
   	elif which==2:
   		x2k=int(round(bk-Ik))		#calculate next position
-  		
-  		if x2k>goto:				#determine moving direction, depending on direction, determine offset
-  			dir=1
-  			offset=hysteresis
-  		else:
-  			dir=0
-  			offset=-1*hysteresis
-  		goto=x2k					#save theoretical position
-  		
-  		pos=x2k+offset				#actual position = theoretical position + offset
-  		focus.go_to_position(pos)	#move lense
-  		img=cam.GrabOne(1000).Array[aoi[1]:aoi[3],aoi[0]:aoi[2]]	#grab image
-  		y2k=fm.fm(img,'TENENGRAD1',5,0).mean()	#calculate contrast
+  		y2k=fm_at(x2k)				#move lense, grab image and calculate contrast
   		
   	if abs(x1k-x2k)<tolerance:		#if interval is smaller than tolerance: break
   		break
@@ -100,6 +248,110 @@ def fibonacci_peak(cam,focus,ak,bk,aoi,hysteresis,tolerance):
   elif (dir==0) and (which==2):
   	return x2k+hysteresis,y2k,nCount
     
+def hill_climb_peak(cam,focus,start,stop,aoi,hysteresis,step=200,tolerance=10,grow=2.0,shrink=0.5,measure=('TENENGRAD1',5,0),cache=None):
+  """Adaptive step hill climbing from the current lense position"""
+  #	meant for a lense near focus: far from it the fm curve is flat and noisy, the climb
+  #	may stop there, use one of the sweeps then
+  #	cam: camera already opened
+  #	focus: focus from used LenseController
+  #	start, stop: step no. range the lense may move in
+  #	aoi: area of interest in form [x1,y1,x2,y2]
+  #	hysteresis: offset to compensate hysteresis (as in fibonacci_peak)
+  #	step: first step size, grows by grow while the fm value rises, shrinks by shrink after
+  #		the peak was passed (direction is reversed then)
+  #	tolerance: algorithm stops when the step becomes smaller than tolerance
+  #	measure: focus measure (fm_name,window_size,threshold)
+  #	cache: optional ScoreCache, consulted before moving the lense
+  #	returns position of the fm maximum, fm maximum value and number of images grabbed
+  fm_at=_Probe(cam,focus,aoi,hysteresis,measure,cache)
+  best=min(max(fm_at.goto,start),stop)
+  best_fm=fm_at(best)
+  dir=1 if stop-best>=best-start else -1	#first probe towards the larger part of the range
+  probing=True		#no rise found yet: a fall only means the wrong direction
+  while step>=tolerance:
+  	x=min(max(int(round(best+dir*step)),start),stop)
+  	if x==best:			#at the end of the range
+  		dir=-dir
+  		step*=shrink
+  		continue
+  	y=fm_at(x)
+  	if y>best_fm:		#still rising: go on with larger steps
+  		best,best_fm=x,y
+  		step*=grow
+  		probing=False
+  	elif probing:		#wrong direction: try the other one with the same step
+  		dir=-dir
+  		probing=False
+  	else:				#peak passed: reverse and shrink
+  		dir=-dir
+  		step*=shrink
+  return best,best_fm,fm_at.n
+
+def brent_peak(cam,focus,start,stop,aoi,hysteresis,tolerance,measure=('TENENGRAD1',5,0),cache=None):
+  """Brent's method (golden section search with parabolic steps) for the fm maximum"""
+  #	R. P. Brent: "Algorithms for Minimization without Derivatives", ch. 5
+  #	cam: camera already opened
+  #	focus: focus from used LenseController
+  #	start, stop: step no. range, the fm curve has to be unimodal in it
+  #	aoi: area of interest in form [x1,y1,x2,y2]
+  #	hysteresis: offset to compensate hysteresis (as in fibonacci_peak)
+  #	tolerance: algorithm stops when the maximum is known to lie within +-tolerance steps
+  #	measure: focus measure (fm_name,window_size,threshold)
+  #	unlike fibonacci_peak no number of loops is needed upfront, a parabola through the last
+  #	three points is used whenever it is trustworthy and no position is grabbed twice
+  #	cache: optional ScoreCache, consulted before moving the lense
+  #	returns position of the fm maximum, fm maximum value and number of images grabbed
+  fm_at=_Probe(cam,focus,aoi,hysteresis,measure,cache)
+  f=lambda x:-fm_at(int(round(x)))	#minimize the negative fm value
+  tol1=max(tolerance/2.0,1.0)	#at least one step between positions
+  tol2=2*tol1
+  a,b=start,stop
+  x=w=v=a+_GOLDEN*(b-a)
+  fx=fw=fv=f(x)
+  d=e=0.0
+  while abs(x-(a+b)/2.0)>tol2-(b-a)/2.0:
+  	xm=(a+b)/2.0
+  	golden=True
+  	if abs(e)>tol1:				#try a parabolic step
+  		r=(x-w)*(fx-fv)
+  		q=(x-v)*(fx-fw)
+  		p=(x-v)*q-(x-w)*r
+  		q=2.0*(q-r)
+  		if q>0:
+  			p=-p
+  		q=abs(q)
+  		etemp=e
+  		e=d
+  		if abs(p)<abs(0.5*q*etemp) and q*(a-x)<p<q*(b-x):	#parabola is trustworthy
+  			d=p/q
+  			golden=False
+  			if (x+d)-a<tol2 or b-(x+d)<tol2:
+  				d=tol1 if xm>=x else -tol1
+  	if golden:					#golden section step into the larger part
+  		e=a-x if x>=xm else b-x
+  		d=_GOLDEN*e
+  	u=x+d if abs(d)>=tol1 else x+(tol1 if d>0 else -tol1)
+  	fu=f(u)
+  	if fu<=fx:
+  		if u>=x:
+  			a=x
+  		else:
+  			b=x
+  		v,w,x=w,x,u
+  		fv,fw,fx=fw,fx,fu
+  	else:
+  		if u<x:
+  			a=u
+  		else:
+  			b=u
+  		if fu<=fw or w==x:
+  			v,w=w,u
+  			fv,fw=fw,fu
+  		elif fu<=fv or v==x or v==w:
+  			v=u
+  			fv=fu
+  return int(round(x)),-fx,fm_at.n
+
 def fibonacci(val):
 #calculates value k and index n of biggest element of fibonacci series for which k<val is true
     if val<=0:
@@ -118,6 +370,7 @@ def fibonacci(val):
             k=kmin1+kmin2 
         return k,n
     
+@functools.lru_cache(maxsize=None)
 def fibonacci2(nin):
 #calculates value k for biggest element of fibonacci series for which k<val is true
     if nin<=0:
@@ -136,9 +389,10 @@ def fibonacci2(nin):
             k=kmin1+kmin2 
         return k
 		
-def global_peak_single_step_debug(cam,focus,step,start,stop,aoi):
+def global_peak_single_step_debug(cam,focus,step,start,stop,aoi,dff=None,measure=('TENENGRAD1',7,0)):
   # steps through complete fm curve using coarse steps
   # returns timer value for global fm maximum, fm maximum value and number of steps
+  # dff: optional DepthFromFocus, is fed every image of the sweep
   max_fm=0		#maximum fm value
   max_index=0		#timer value corresponding to maximum fm value
   index=start		#first timer value
@@ -149,37 +403,108 @@ def global_peak_single_step_debug(cam,focus,step,start,stop,aoi):
   	focus.go_to_position(index) #move lense to next position
   	img=cam.GrabOne(1000).Array[aoi[1]:aoi[3],aoi[0]:aoi[2]]	
   	#grab image and calculate fm value in AOI
-  	fm_vals.append(fm.fm(img,'TENENGRAD1',7,0).mean())
+  	fm_vals.append(fm.score(img,*measure))
+  	if dff is not None:
+  		dff.update(img,index)
   	index+=step #calculate next timer value    
   return fm_vals
 	
-def global_peak_single_step(cam,focus,step,start,stop,aoi):
+def _score_worker(fm,jobs,scores,errors,measure,level):
+  # computes the fm values of the (index,img) jobs until None is received
+  # after an error the remaining jobs are only taken, so the sweep never blocks
+  while True:
+  	job=jobs.get()
+  	if job is None:
+  		return
+  	if not errors:
+  		try:
+  			scores.append((job[0],fm.score(job[1],*measure,level=level)))
+  		except Exception as e:
+  			errors.append(e)
+
+def global_peak_single_step(cam,focus,step,start,stop,aoi,level=0,measure=('TENENGRAD1',7,0),pipeline=0,curve=None,cache=None,hysteresis=0):
   # steps through complete fm curve using coarse steps
   # returns timer value for global fm maximum, fm maximum value and number of steps
+  # level: image pyramid level the fm values are calculated on (0: full resolution)
+  # measure: focus measure (fm_name,window_size,threshold), e.g. from select_measure
+  # pipeline: if >0 the fm values are calculated by a worker thread while the lense moves on
+  #	and grabs, at most pipeline images wait for it. The result is the same
+  # curve: optional list, (timer value,fm value) of every step are appended
+  # cache: optional ScoreCache, consulted before moving the lense. Every timer value is
+  #	approached forward, after cache hits the lense is moved below it first
+  # hysteresis: only for the cache, the lense moved forward to a timer value is at timer value
+  #	- hysteresis (as the caller corrects the result)
   max_fm=0		#maximum fm value
   max_index=0		#timer value corresponding to maximum fm value
   index=start		#first timer value
   steps=0			#number of steps
   fm = ContrastMeasures()
-  #loop through timer values
-  while index<=stop:
-  	focus.go_to_position(index) #move lense to next position
-  	img=cam.GrabOne(1000).Array[aoi[1]:aoi[3],aoi[0]:aoi[2]]	
-  	#grab image and calculate fm value in AOI
-  	fm_val=fm.fm(img,'TENENGRAD1',7,0).mean()
+  scores=[]		#(timer value,fm value) in sweep order
+  hits=[]			#(timer value,fm value) found in cache
+  key=tuple(measure)+(level,)
+  if cache is not None:
+  	cache.check(cam,aoi)
+  if pipeline:
+  	jobs=queue.Queue(pipeline)
+  	errors=[]
+  	worker=threading.Thread(target=_score_worker,args=(fm,jobs,scores,errors,measure,level))
+  	worker.start()
+  try:
+  	#loop through timer values
+  	while index<=stop:
+  		fm_val=None if cache is None else cache.get(index-hysteresis,1,aoi,key)
+  		if fm_val is not None:	#known: no need to move and grab
+  			hits.append((index,fm_val))
+  		else:
+  			if cache is not None and focus.get_position()>=index:
+  				#lense left behind by hits: approach from below like the sweep, the curve
+  				#must not mix both sides of the hysteresis
+  				focus.go_to_position(max(index-step,focus.get_min_position()))
+  			focus.go_to_position(index) #move lense to next position
+  			img=cam.GrabOne(1000).Array[aoi[1]:aoi[3],aoi[0]:aoi[2]]	
+  			#grab image and calculate fm value in AOI
+  			if pipeline:
+  				jobs.put((index,img))	#blocks if the worker is pipeline images behind
+  			else:
+  				scores.append((index,fm.score(img,*measure,level=level)))
+  		steps+=1	#increase number of steps
+  		index+=step #calculate next timer value    
+  finally:
+  	if pipeline:
+  		jobs.put(None)
+  		worker.join()
+  if pipeline and errors:
+  	raise errors[0]
+  if cache is not None:
+  	for index,fm_val in scores:
+  		cache.put(index-hysteresis,1,aoi,key,fm_val)
+  	scores=sorted(scores+hits)	#sweep order
+  if curve is not None:
+  	curve.extend(scores)
+  for index,fm_val in scores:
   	if fm_val > max_fm:	#check if maximum occured
   		max_fm=fm_val	#save maximum fm value
   		max_index=index	#save timer value corresponding to maximum fm value
-  	steps+=1	#increase number of steps
-  	index+=step #calculate next timer value    
   return max_index,max_fm,steps	
 	
-def global_peak_two_step(cam,focus,c_step,f_step,start,stop,aoi,hysteresis):
+def global_peak_two_step(cam,focus,c_step,f_step,start,stop,aoi,hysteresis,c_level=1,measure=('TENENGRAD1',7,0),pipeline=0,fit='lorentz',min_quality=0.95,points=5,cache=None):
 # steps through complete fm curve using coarse steps
 # applies fine step search around maximum
 # returns timer value for global fm maximum, fm maximum value and number of steps
-	#apply coarse step peak search
-	cmax,cfm,csteps=global_peak_single_step(cam,focus,c_step,start,stop,aoi) 
+# c_level: image pyramid level for the coarse search, the fine search uses full resolution
+# pipeline, cache: see global_peak_single_step. The cache saves frames when two_step runs
+#	again on the same scene. Within one run the coarse samples count for the fine search only
+#	with c_level=0, hysteresis=0 and c_step a multiple of f_step: otherwise they are of
+#	another pyramid level or lie off the fine grid (shifted by -hysteresis)
+# fit: model interpolate_peak fits to the points coarse values around the maximum, the fine
+#	search only runs if the fit quality is below min_quality (fit=None: always fine search)
+	#apply coarse step peak search on reduced resolution
+	curve=[]
+	cmax,cfm,csteps=global_peak_single_step(cam,focus,c_step,start,stop,aoi,c_level,measure,pipeline,curve,cache,hysteresis) 
+	if fit is not None:
+		pos,fit_fm,quality=interpolate_peak(curve,fit,points)
+		if quality>=min_quality:	#good fit: no fine search needed
+			return int(round(pos)),fit_fm,csteps
 	#calculate new start and stop values for fine step search
 	if cmax<c_step:
 		s0=0
@@ -187,9 +512,232 @@ def global_peak_two_step(cam,focus,c_step,f_step,start,stop,aoi,hysteresis):
 		s0=cmax-c_step
 	#apply fine step peak search	
 	print(s0,cmax+c_step)
-	fmax,ffm,fsteps=global_peak_single_step(cam,focus,f_step,s0-hysteresis,cmax+c_step-hysteresis,aoi)
+	fmax,ffm,fsteps=global_peak_single_step(cam,focus,f_step,s0-hysteresis,cmax+c_step-hysteresis,aoi,measure=measure,pipeline=pipeline,cache=cache,hysteresis=hysteresis)
 	#total number of steps = number of steps for coarse search + number of steps for fine search
 	steps=csteps+fsteps	
 	return fmax,ffm,steps
-	
-	
\ No newline at end of file
+
+def interpolate_peak(curve,model='gauss',points=5):
+  # fits model to the points (3-7) values of curve [(position,fm value),...] around its maximum
+  # model: 'parabola' (y=p(x)), 'gauss' (ln(y)=p(x)) or 'lorentz' (1/y=p(x)), p of 2nd degree
+  # returns sub-step position and fm value of the peak and the fit quality: the coefficient
+  # of determination (R^2) of the fitted values, 0 if the fit is no maximum or the peak lies
+  # outside the used points (e.g. at the end of the sweep)
+  x=np.array([c[0] for c in curve],float)
+  y=np.array([c[1] for c in curve],float)
+  i=int(np.argmax(y))
+  lo=max(i-points//2,0)
+  hi=min(lo+points,len(y))
+  lo=max(hi-points,0)
+  x=x[lo:hi]
+  y=y[lo:hi]
+  if len(y)<3 or i in (0,len(curve)-1):	#peak not enclosed by the sweep
+  	return float(x[i-lo]),float(y[i-lo]),0.0
+  if model=='parabola':
+  	t=y
+  elif model=='gauss':
+  	if y.min()<=0:
+  		return float(x[i-lo]),float(y[i-lo]),0.0
+  	t=np.log(y)
+  elif model=='lorentz':
+  	if y.min()<=0:
+  		return float(x[i-lo]),float(y[i-lo]),0.0
+  	t=1/y
+  else:
+  	raise ValueError('unknown model: %s' % model)
+  x0=x[i-lo]
+  scale=float(np.abs(x-x0).max())
+  a,b,c=np.polyfit((x-x0)/scale,t,2)		#centred and scaled for a well conditioned fit
+  if (a>=0 and model!='lorentz') or (a<=0 and model=='lorentz'):	#no maximum
+  	return float(x0),float(y[i-lo]),0.0
+  u=-b/(2*a)		#vertex
+  if not x[0]<=x0+u*scale<=x[-1]:	#vertex outside the points
+  	return float(x0),float(y[i-lo]),0.0
+  if model=='parabola':
+  	f=lambda v:a*v*v+b*v+c
+  elif model=='gauss':
+  	f=lambda v:np.exp(a*v*v+b*v+c)
+  else:
+  	f=lambda v:1/(a*v*v+b*v+c)
+  res=y-f((x-x0)/scale)
+  tot=y-y.mean()
+  quality=1-np.dot(res,res)/np.dot(tot,tot) if np.dot(tot,tot)>0 else 0.0
+  return float(x0+u*scale),float(f(u)),max(float(quality),0.0)
+
+def select_measure(cam,focus,selector,start,stop,aoi,samples=7,key=None):
+  # grabs samples images evenly spread from start to stop and lets selector (MeasureSelector)
+  # pick the focus measure for the searches above
+  # key: scene/AOI the choice is cached for, default: aoi
+  # returns measure (fm_name,window_size,threshold)
+  if key is None:
+  	key=tuple(aoi)
+  if selector.cached(key) is not None:	#probed before: no need to move the lense
+  	return selector.cached(key)
+  frames=[]
+  for i in range(samples):
+  	focus.go_to_position(int(round(start+(stop-start)*i/float(samples-1))))
+  	frames.append(cam.GrabOne(1000).Array[aoi[1]:aoi[3],aoi[0]:aoi[2]])
+  return selector.select(frames,key)
+
+def global_peak_continuous(cam,focus,start,stop,aoi,chunk=20,measure=('TENENGRAD1',7,0),curve=None):
+  # moves the lense in one pass from start to stop while the camera grabs continuously
+  # (GrabStrategy_LatestImages as set up by af_gui.CameraControlBox, else grabbing is started here)
+  # the motor only pauses after every chunk steps to take the frames which are ready
+  # every frame gets the lense position at the middle of its exposure, interpolated from the
+  # step pulse timeline of focus (DriverController) and the frame time stamps
+  # curve: optional list, (position,fm value) of every frame are appended
+  # returns position of the fm maximum, fm maximum value and number of frames
+  fm = ContrastMeasures()
+  focus.go_to_position(start)
+  grabbing=cam.IsGrabbing()
+  if not grabbing:
+  	cam.StartGrabbing()
+  while cam.NumReadyBuffers:	#drop frames taken before the sweep
+  	cam.RetrieveResult(1000).Release()
+  cam.TimestampLatch.Execute()	#offset of camera time stamps to host time
+  offset=focus.now()-cam.TimestampLatchValue()*1e-9
+  exposure=cam.ExposureTime()*1e-6
+  focus.timeline=[(focus.now(),focus.get_position())]
+  frames=[]		#(middle of exposure,image)
+  position=start
+  try:
+  	while position<stop:
+  		n=min(chunk,stop-position)
+  		focus.go_n_steps(n)
+  		position+=n
+  		while cam.NumReadyBuffers:
+  			res=cam.RetrieveResult(1000)
+  			try:
+  				if res.GrabSucceeded():
+  					frames.append((res.TimeStamp*1e-9+offset+exposure/2,res.Array[aoi[1]:aoi[3],aoi[0]:aoi[2]].copy()))
+  			finally:
+  				res.Release()
+  finally:
+  	timeline=np.array(focus.timeline)
+  	focus.timeline=None
+  	if not grabbing:
+  		cam.StopGrabbing()
+  max_fm=0		#maximum fm value
+  max_pos=start	#position corresponding to maximum fm value
+  for t,img in frames:
+  	pos=float(np.interp(t,timeline[:,0],timeline[:,1]))
+  	fm_val=fm.score(img,*measure)
+  	if curve is not None:
+  		curve.append((pos,fm_val))
+  	if fm_val > max_fm:
+  		max_fm=fm_val
+  		max_pos=pos
+  return int(round(max_pos)),max_fm,len(frames)
+
+class FocusTracker:
+  """Continuous tracking autofocus for live video"""
+  #	feed every new video frame with update(img), img: the aoi of the frame. The fm value
+  #	is watched, does it drop by more than drift against the value at the peak, the lense
+  #	dithers: it moves dither steps to either side and a parabola through the three fm
+  #	values re-centers it. Is the value below lost times the peak value or is no peak found
+  #	within max_dithers dithers, tracking is lost and global_peak_continuous searches the
+  #	peak, first within +-reacquire steps, then from start to stop (needs continuous
+  #	grabbing, as in the live video) and a dither refines its peak
+  #	cam, focus, aoi, hysteresis, measure: as for the searches
+  #	start, stop: step no. range the lense may move in
+  #	settle: frames skipped after each move (they were exposed while moving)
+  def __init__(self,cam,focus,aoi,start,stop,hysteresis=0,measure=('TENENGRAD1',7,0),dither=20,drift=0.1,lost=0.3,settle=2,max_dithers=4,reacquire=600):
+  	self.cam=cam
+  	self.focus=focus
+  	self.aoi=aoi
+  	self.start=start
+  	self.stop=stop
+  	self.hysteresis=hysteresis
+  	self.measure=measure
+  	self.dither=dither
+  	self.drift=drift
+  	self.lost=lost
+  	self.settle=settle
+  	self.max_dithers=max_dithers
+  	self.reacquire=reacquire
+  	self.fm=ContrastMeasures()
+  	self.goto=focus.get_position()	#last theoretical position
+  	self.center=self.goto		#position of the peak
+  	self.peak=None				#fm value at the peak
+  	self.state='monitor'		#'monitor', 'dither' or 'settle'
+  	self.skip=0					#frames still to skip
+  	self.dithers=0				#dithers without finding the peak
+  	self.samples={}				#position: fm value of the current dither
+  	self.plan=[]				#positions of the current dither still to measure
+  	self.moves=0				#number of moves
+  	self.searches=0				#number of searches (tracking lost)
+  	
+  def update(self,img):
+  	# next video frame (aoi), returns the state
+  	if self.skip>0:
+  		self.skip-=1
+  		return self.state
+  	y=self.fm.score(img,*self.measure)
+  	if self.state=='monitor':
+  		if self.peak is None or y>self.peak:
+  			self.peak=y
+  		elif y<self.lost*self.peak:
+  			self._search()
+  		elif y<(1-self.drift)*self.peak:	#drifted: look to either side
+  			self.samples={self.center:y}
+  			self._dither([self.center+self.dither,self.center-self.dither])
+  	elif self.state=='dither':
+  		self.samples[self.goto]=y
+  		self.plan.pop(0)
+  		if self.plan:
+  			self._move(self.plan[0])
+  		else:
+  			self._recenter()
+  	else:						#first value at the new center is the new peak value
+  		self.peak=y
+  		self.state='monitor'
+  	return self.state
+  	
+  def _clip(self,x):
+  	return min(max(int(round(x)),self.start),self.stop)
+  	
+  def _move(self,x):
+  	x=self._clip(x)
+  	if x!=self.goto:
+  		offset=self.hysteresis if x>self.goto else -1*self.hysteresis
+  		self.focus.go_to_position(x+offset)
+  		self.goto=x
+  		self.moves+=1
+  		self.skip=self.settle
+  	
+  def _dither(self,plan):
+  	self.plan=[self._clip(x) for x in plan]
+  	self.state='dither'
+  	self._move(self.plan[0])
+  	
+  def _recenter(self):
+  	pos,fm_val,quality=interpolate_peak(sorted(self.samples.items()),'parabola',3)
+  	if quality>0:				#peak between the dither positions
+  		self.dithers=0
+  		self.center=self._clip(pos)
+  		self.state='settle'
+  		self._move(self.center)
+  		return
+  	self.dithers+=1
+  	if self.dithers>self.max_dithers:
+  		self._search()
+  		return
+  	best=max(self.samples,key=self.samples.get)	#peak outside: go on towards the better side
+  	self.center=self._clip(self.center+2*self.dither*_direction(best,self.center))
+  	self.samples={}
+  	self._dither([self.center,self.center+self.dither,self.center-self.dither])
+  	
+  def _search(self):
+  	self.searches+=1
+  	lo=max(self.start,self.center-self.reacquire)
+  	hi=min(self.stop,self.center+self.reacquire)
+  	pos,fm_val,n=global_peak_continuous(self.cam,self.focus,lo,hi,self.aoi,measure=self.measure)
+  	margin=self.reacquire//4
+  	if (pos-lo<margin and lo>self.start) or (hi-pos<margin and hi<self.stop) or fm_val<self.lost*self.peak:	#peak beyond the range
+  		pos,fm_val,n=global_peak_continuous(self.cam,self.focus,self.start,self.stop,self.aoi,measure=self.measure)
+  	self.goto=self.focus.get_position()
+  	self.dithers=0
+  	self.center=self._clip(pos)
+  	self.samples={}				#refine the peak of the sweep by a dither
+  	self._dither([self.center,self.center+self.dither,self.center-self.dither])
+  	self.skip=self.settle		#also after a search which ended at the peak
@@ -0,0 +1,490 @@
+# simulated devices and synthetic scenes to run and benchmark the
+# autofocus without hardware
+# all devices advance a shared clock instead of sleeping, so runs are
+# deterministic and report the time they would take on the real setup
+
+import bisect
+import time
+import cv2
+import numpy as np
+
+# number of rendered frames SimCamera keeps for reuse
+_MAX_RENDERED = 64
+
+# full scale value of a dtype
+_FULL_SCALE = {'uint8': 255.0, 'uint16': 65535.0, 'float32': 255.0}
+
+
+def textured_scene(shape, seed=0):
+    """
+    sharp synthetic scene in [0, 1]: noise at several scales (texture of
+    every frequency) plus a few bright and dark rectangles (edges)"""
+    h, w = shape
+    rng = np.random.default_rng(seed)
+    scene = np.zeros(shape, np.float32)
+    for octave in range(5):
+        f = 2**octave
+        noise = rng.random((h // f + 1, w // f + 1)).astype(np.float32)
+        scene += cv2.resize(noise, (w, h), interpolation=cv2.INTER_LINEAR)
+    scene /= 5
+    for _ in range(8):
+        y, x = rng.integers(0, h), rng.integers(0, w)
+        scene[y:y + h // 6, x:x + w // 6] = rng.integers(0, 2)
+    return scene
+
+
+def defocus(scene, sigma, dtype='uint8', noise=0.0, rng=None):
+    """
+    scene blurred by a gaussian of sigma (0: sharp), scaled to the full
+    range of dtype, with optional gaussian noise of standard deviation
+    noise (in units of the full range)"""
+    img = scene if sigma <= 0 else cv2.GaussianBlur(scene, (0, 0), sigma)
+    if noise > 0:
+        rng = np.random.default_rng() if rng is None else rng
+        img = img + rng.normal(0, noise, img.shape).astype(np.float32)
+    img = np.clip(img, 0, 1) * _FULL_SCALE[dtype]
+    if dtype != 'float32':
+        img = np.rint(img)
+    return img.astype(dtype)
+
+
+class SimClock():
+    """simulated time in seconds, sleep advances it immediately"""
+
+    def __init__(self, start=0.0):
+        self.t = start
+
+    def time(self):
+        return self.t
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            self.t += seconds
+
+
+class RealClock():
+    """wall clock with the SimClock interface, for interactive use"""
+
+    def __init__(self):
+        self.start = time.monotonic()
+
+    def time(self):
+        return time.monotonic() - self.start
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+
+class SimGPIO():
+    """
+    stand-in for RPi.GPIO (LenseController(gpio=SimGPIO())): records every
+    output change as (time, pin, value) in events and passes it on to the
+    attached SimSteppers. sleep advances clock, so the step delays of
+    DriverController cost simulated time only
+    """
+
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    HIGH = True
+    LOW = False
+
+    def __init__(self, clock=None, record=True):
+        self.clock = SimClock() if clock is None else clock
+        self.record = record
+        self.mode = None
+        self.events = []
+        self.steppers = []
+        self._levels = {}
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, initial=False):
+        self._levels[pin] = bool(initial)
+
+    def output(self, pin, value):
+        if pin not in self._levels:
+            raise RuntimeError('pin %d is not set up' % pin)
+        value = bool(value)
+        if self.record:
+            self.events.append((self.clock.time(), pin, value))
+        old = self._levels[pin]
+        self._levels[pin] = value
+        for stepper in self.steppers:
+            stepper.edge(pin, old, value)
+
+    def input(self, pin):
+        return self._levels[pin]
+
+    def cleanup(self):
+        self._levels.clear()
+
+    def sleep(self, seconds):
+        self.clock.sleep(seconds)
+
+    def attach(self, stepper):
+        self.steppers.append(stepper)
+
+
+class SimStepper():
+    """
+    stepper motor with lens on the dir, step and enable pins of a
+    DriverController (enable is active low, dir high is forward). On
+    each rising edge of step the motor steps unless
+    - the pulse came less than min_step_period after the last step
+      (motor cannot follow, step lost)
+    - a random step is lost with probability step_loss
+    - it takes up backlash: after a change of direction the first
+      backlash steps do not move the lens
+    The lens stays within [0, max_position]. Step times, direction
+    changes and the lens position over time (position_at) are recorded
+    """
+
+    def __init__(self, gpio, pins, max_position, backlash=0,
+                 min_step_period=0.0, step_loss=0.0, position=0, seed=0):
+        self.gpio = gpio
+        self.pins = pins
+        self.max_position = max_position
+        self.backlash = backlash
+        self.min_step_period = min_step_period
+        self.step_loss = step_loss
+        self.position = position
+        # pulses received, lost steps, reversals of the direction
+        self.steps = 0
+        self.lost = 0
+        self.direction_changes = 0
+        self.step_times = []
+        self._history_t = [gpio.clock.time()]
+        self._history_p = [position]
+        self._direction = None
+        self._slack = 0
+        self._last_step = None
+        self._rng = np.random.default_rng(seed)
+        gpio.attach(self)
+
+    def edge(self, pin, old, new):
+        if pin != self.pins[1] or old or not new:
+            return
+        if self.gpio.input(self.pins[2]):
+            # driver disabled
+            return
+        t = self.gpio.clock.time()
+        self.steps += 1
+        self.step_times.append(t)
+        direction = 1 if self.gpio.input(self.pins[0]) else -1
+        if direction != self._direction:
+            if self._direction is not None:
+                self.direction_changes += 1
+                self._slack = self.backlash
+            self._direction = direction
+        too_fast = self._last_step is not None and \
+            t - self._last_step < self.min_step_period
+        self._last_step = t
+        if too_fast or (self.step_loss > 0 and
+                        self._rng.random() < self.step_loss):
+            self.lost += 1
+            return
+        if self._slack > 0:
+            self._slack -= 1
+            return
+        position = min(max(self.position + direction, 0), self.max_position)
+        if position != self.position:
+            self.position = position
+            self._history_t.append(t)
+            self._history_p.append(position)
+
+    def get_position(self):
+        """actual lens position (the DriverController only counts pulses)"""
+        return self.position
+
+    def position_at(self, t):
+        """lens position at time t"""
+        i = bisect.bisect_right(self._history_t, t)
+        return self._history_p[max(i - 1, 0)]
+
+
+def simulated_lense(clock=None, backlash=0, step_loss=0.0, seed=0):
+    """
+    LenseController on a SimGPIO with a SimStepper per axis, returns
+    (lense, gpio, steppers) with steppers indexed by the axis ID. The
+    motors start at their maximum position, so open() really moves them
+    to 0 like the hardware"""
+    from LenseController import LenseController
+    gpio = SimGPIO(clock)
+    lense = LenseController(gpio)
+    axes = (
+        lense.irisPins, lense.focusPins, lense.zoomPins)
+    steppers = []
+    for i, pins in enumerate(axes):
+        for pin in pins:
+            gpio.setup(pin, gpio.OUT, initial=pin == pins[2])
+        steppers.append(SimStepper(
+                                gpio,
+                                pins,
+                                lense.maxPositions[i],
+                                backlash,
+                                lense.motorDelay[i],
+                                step_loss,
+                                lense.maxPositions[i],
+                                seed + i))
+    lense.open()
+    return lense, gpio, steppers
+
+
+class _Parameter():
+    """camera parameter, read with cam.Name() or cam.Name.Value"""
+
+    def __init__(self, value):
+        self.Value = value
+
+    def __call__(self):
+        return self.Value
+
+    def GetValue(self):
+        return self.Value
+
+    def SetValue(self, value):
+        self.Value = value
+
+
+class _Command():
+    """camera command, run with cam.Name.Execute()"""
+
+    def __init__(self, func):
+        self.Execute = func
+
+
+class SimGrabResult():
+    """grab result with the parts of the pylon GrabResult the code uses"""
+
+    def __init__(self, array, timestamp, block_id, position):
+        self.Array = array
+        # pylon time stamps are in ns
+        self.TimeStamp = int(round(timestamp * 1e9))
+        self.BlockID = block_id
+        # lens position the frame was rendered for
+        self.position = position
+        self.released = False
+
+    def GrabSucceeded(self):
+        return self.Array is not None
+
+    def Release(self):
+        self.released = True
+
+    def __bool__(self):
+        return True
+
+
+class SimCamera():
+    """
+    simulated camera with the pylon InstantCamera interface used by the
+    searches (GrabOne) and af_gui.CameraControlBox (Open, ExposureTime,
+    StartGrabbing, NumReadyBuffers, RetrieveResult, ...).
+    Frames show scene (default: textured_scene) blurred by a gaussian of
+    sigma = min_blur + blur_per_step * |lens position - in_focus|, at
+    most max_blur. The lens position is focus.position_at(t) at the
+    middle of the exposure if focus has it, else focus.get_position().
+    Brightness scales with ExposureTime / reference_exposure (saturating),
+    noise is the standard deviation of gaussian noise relative to full
+    scale. A new exposure starts at most every frame_period seconds and
+    the frame is ready readout seconds after the exposure ended; the
+    camera sleeps on clock until then. All random numbers come from seed,
+    so a run is reproducible
+    """
+
+    def __init__(self, focus=None, scene=None, shape=(480, 640),
+                 in_focus=3000, blur_per_step=0.005, min_blur=0.0,
+                 max_blur=16.0, exposure_time=10000.0,
+                 reference_exposure=10000.0, noise=0.005, frame_period=0.04,
+                 readout=0.01, dtype='uint8', clock=None, seed=0):
+        self.focus = focus
+        # lens position if there is no focus
+        self.position = in_focus
+        self.scene = textured_scene(shape, seed) if scene is None else scene
+        self.in_focus = in_focus
+        self.blur_per_step = blur_per_step
+        self.min_blur = min_blur
+        self.max_blur = max_blur
+        self.reference_exposure = reference_exposure
+        self.noise = noise
+        self.frame_period = frame_period
+        self.readout = readout
+        self.dtype = dtype
+        self.clock = SimClock() if clock is None else clock
+        self.Width = _Parameter(self.scene.shape[1])
+        self.Height = _Parameter(self.scene.shape[0])
+        self.ExposureTime = _Parameter(float(exposure_time))
+        self.ExposureAuto = _Parameter('Off')
+        self.GainAuto = _Parameter('Off')
+        # camera time stamps are the clock in ns
+        self.TimestampLatchValue = _Parameter(0)
+        self.TimestampLatch = _Command(self._latch)
+        self.frames = 0
+        self._rng = np.random.default_rng(seed)
+        self._rendered = {}
+        self._open = False
+        self._grabbing = False
+        self._next_start = 0.0
+        self._retrieved = 0.0
+
+    def __setattr__(self, name, value):
+        # cam.ExposureTime = T sets the value like pylon does
+        p = self.__dict__.get(name)
+        if isinstance(p, _Parameter) and not isinstance(value, _Parameter):
+            p.Value = value
+        else:
+            object.__setattr__(self, name, value)
+
+    def _latch(self):
+        self.TimestampLatchValue = int(round(self.clock.time() * 1e9))
+
+    def Open(self):
+        self._open = True
+
+    def Close(self):
+        self._grabbing = False
+        self._open = False
+
+    def IsOpen(self):
+        return self._open
+
+    def StartGrabbing(self, strategy=None):
+        self._grabbing = True
+        self._next_start = max(self._next_start, self.clock.time())
+        self._retrieved = self._next_start
+
+    def StopGrabbing(self):
+        self._grabbing = False
+
+    def IsGrabbing(self):
+        return self._grabbing
+
+    @property
+    def NumReadyBuffers(self):
+        """1 if a frame was finished since the last RetrieveResult"""
+        if not self._grabbing:
+            return 0
+        return int(self._latest_start() is not None)
+
+    def _exposure(self):
+        return self.ExposureTime.Value * 1e-6
+
+    def _latest_start(self):
+        """start of the latest finished, not retrieved frame or None"""
+        done = self.clock.time() - self._exposure() - self.readout
+        if done < self._retrieved:
+            return None
+        n = int((done - self._retrieved) / self.frame_period)
+        return self._retrieved + n * self.frame_period
+
+    def RetrieveResult(self, timeout, handling=None):
+        """
+        latest frame of continuous grabbing (GrabStrategy_LatestImages),
+        waits for the next one if none is ready. timeout in ms"""
+        if not self._grabbing:
+            raise RuntimeError('camera is not grabbing')
+        start = self._latest_start()
+        if start is None:
+            start = self._retrieved
+            ready = start + self._exposure() + self.readout
+            if ready - self.clock.time() > timeout * 1e-3:
+                self.clock.sleep(timeout * 1e-3)
+                raise TimeoutError('no frame within %d ms' % timeout)
+            self.clock.sleep(ready - self.clock.time())
+        self._retrieved = start + self.frame_period
+        return self._frame(start)
+
+    def GrabOne(self, timeout):
+        """single frame, exposed from now on (or the next frame slot)"""
+        if self._grabbing:
+            raise RuntimeError('camera is already grabbing')
+        start = max(self.clock.time(), self._next_start)
+        ready = start + self._exposure() + self.readout
+        if ready - self.clock.time() > timeout * 1e-3:
+            raise TimeoutError('no frame within %d ms' % timeout)
+        self.clock.sleep(ready - self.clock.time())
+        self._next_start = start + self.frame_period
+        return self._frame(start)
+
+    def lens_position(self, t):
+        """lens position at time t"""
+        if self.focus is None:
+            return self.position
+        if hasattr(self.focus, 'position_at'):
+            return self.focus.position_at(t)
+        return self.focus.get_position()
+
+    def blur(self, position):
+        """sigma of the gaussian defocus at lens position"""
+        return min(self.max_blur, self.min_blur +
+                   self.blur_per_step * abs(position - self.in_focus))
+
+    def render(self, position):
+        """frame at lens position"""
+        sigma = round(self.blur(position), 3)
+        gain = self.ExposureTime.Value / self.reference_exposure
+        key = (sigma, gain)
+        img = self._rendered.get(key)
+        if img is None:
+            if len(self._rendered) >= _MAX_RENDERED:
+                self._rendered.clear()
+            img = defocus(self.scene, sigma, 'float32') * (gain / 255)
+            self._rendered[key] = img
+        return defocus(img, 0, self.dtype, self.noise, self._rng)
+
+    def _frame(self, start):
+        position = self.lens_position(start + self._exposure() / 2)
+        img = self.render(position)
+        self.frames += 1
+        return SimGrabResult(img, start, self.frames, position)
+
+
+class ReplayCamera(SimCamera):
+    """
+    SimCamera showing recorded frames (see record_sweep): each grab
+    returns the frame recorded closest to the lens position. Timing is
+    the same as for SimCamera (keyword arguments), in_focus defaults to
+    the middle of the recording and only serves as ground truth
+    """
+
+    def __init__(self, positions, frames, focus=None, **kwargs):
+        self.positions = np.asarray(positions)
+        self.recorded = frames
+        kwargs.setdefault('in_focus', int(np.median(self.positions)))
+        kwargs.setdefault('dtype', frames[0].dtype)
+        SimCamera.__init__(
+                        self,
+                        focus,
+                        np.zeros(frames[0].shape, np.float32),
+                        **kwargs)
+
+    def render(self, position):
+        return self.recorded[np.abs(self.positions - position).argmin()]
+
+
+def record_sweep(cam, focus, start, stop, step, path=None):
+    """
+    grabs a frame every step lens positions from start to stop, returns
+    (positions, frames) and saves them to the .npz file path if given"""
+    positions = list(range(start, stop + 1, step))
+    frames = []
+    for position in positions:
+        focus.go_to_position(position)
+        frames.append(cam.GrabOne(1000).Array)
+    frames = np.array(frames)
+    if path is not None:
+        np.savez_compressed(path, positions=positions, frames=frames)
+    return np.array(positions), frames
+
+
+def load_recording(path):
+    """(positions, frames) saved by record_sweep"""
+    with np.load(path) as f:
+        return f['positions'], f['frames']